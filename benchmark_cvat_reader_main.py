@@ -0,0 +1,101 @@
+import argparse
+import gc
+import math
+import os.path
+import random
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+from src.common.logger import get_logger
+from src.converters.cvat_reader import BO_SHAPE_TYPES, CVATReader
+
+logger = get_logger(__name__)
+
+
+"""
+micro-benchmark for the per-image shape scan in CVATReader:
+one findall per BO_SHAPE_TYPES entry vs. a single pass over the children
+"""
+
+LABELS = ["person", "chair", "table", "pillar", "sign"]
+
+
+def create_synthetic_xml(filename: str, image_count: int, objects_per_image: int, seed=0):
+    rnd = random.Random(seed)
+    with open(filename, 'w', encoding='utf-8') as xml_file:
+        xml_file.write('<?xml version="1.0" encoding="utf-8"?>\n<annotations>\n')
+        xml_file.write('  <version>1.1</version>\n  <meta><task><name>synthetic</name></task></meta>\n')
+        for image_id in range(image_count):
+            xml_file.write(f'  <image id="{image_id}" name="{image_id:06d}.jpg" width="1920" height="1080">\n')
+            for _ in range(objects_per_image):
+                object_type = rnd.choice(BO_SHAPE_TYPES)
+                label = rnd.choice(LABELS)
+                if object_type == 'box':
+                    xml_file.write(f'    <box label="{label}" occluded="0" xtl="10.00" ytl="20.00" '
+                                   f'xbr="30.00" ybr="40.00" z_order="0"/>\n')
+                else:
+                    xml_file.write(f'    <{object_type} label="{label}" occluded="0" '
+                                   f'points="1.00,2.00;3.00,4.00" z_order="0"/>\n')
+            xml_file.write('  </image>\n')
+        xml_file.write('</annotations>\n')
+
+
+def convert_shapes_findall(el_image, convert_object) -> list:
+    """
+    the original scan: one findall per shape type
+    """
+    converted = []
+    for object_type in BO_SHAPE_TYPES:
+        for el_object in el_image.findall(object_type):
+            converted.append(convert_object(el_object, object_type))
+    return converted
+
+
+def _pair(el_object, object_type):
+    return object_type, el_object
+
+
+def time_scan(scan, el_images, convert_object, repeat: int):
+    best = math.inf
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        for el_image in el_images:
+            scan(el_image, convert_object)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark(image_count: int, objects_per_image: int, repeat: int):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        xml_filename = os.path.join(temp_dir, "annotations.xml")
+        logger.info(f"Creating {image_count} images x {objects_per_image} objects in {xml_filename}")
+        create_synthetic_xml(xml_filename, image_count, objects_per_image)
+
+        el_images = ET.parse(xml_filename).getroot().findall('image')
+
+    for el_image in el_images:
+        if convert_shapes_findall(el_image, _pair) != CVATReader.convert_shapes(el_image, _pair):
+            logger.error(f"ERROR: object order differs in image {el_image.attrib['id']}")
+            return
+
+    cvat_reader = CVATReader()
+    for name, convert_object in [("scan only", _pair), ("scan + DataLabels.Object", cvat_reader._create_object)]:
+        elapsed_findall = time_scan(convert_shapes_findall, el_images, convert_object, repeat)
+        elapsed_single_pass = time_scan(CVATReader.convert_shapes, el_images, convert_object, repeat)
+
+        logger.info(f"[{name}] findall per type: {elapsed_findall:.3f}s "
+                    f"single pass: {elapsed_single_pass:.3f}s "
+                    f"ratio: {elapsed_findall / elapsed_single_pass:.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", action="store", dest="images", type=int, default=50000)
+    parser.add_argument("--objects", action="store", dest="objects", type=int, default=30)
+    parser.add_argument("--repeat", action="store", dest="repeat", type=int, default=3)
+
+    args = parser.parse_args()
+
+    benchmark(args.images, args.objects, args.repeat)
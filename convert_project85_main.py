@@ -1,13 +1,17 @@
 import argparse
+import functools
+import hashlib
+import json
 import os.path
+from concurrent.futures import ProcessPoolExecutor
 
+import src.common.serializer as serializer
 import src.common.utils as utils
 from src.common.logger import get_logger
+from src.common.output_sink import create_output_sink, is_archive
 from src.converters.cvat_reader import CVATReader
 from src.converters.project85_csv_reader import Project85CsvReader
 from src.converters.project85_writer import Project85Writer
-from src.models.adq_labels import AdqLabels
-from src.models.data_labels import DataLabels
 
 logger = get_logger(__name__)
 
@@ -29,33 +33,185 @@ IMU_COLUMNS4 = ["accelerometer_linear_acceleration.x", "accelerometer_linear_acc
 IMU_COLUMNS5 = ["accelerometer_linear_acceleration.z"]
 IMU_COLUMNS = IMU_COLUMNS1 + IMU_COLUMNS2 + IMU_COLUMNS3 + IMU_COLUMNS4 + IMU_COLUMNS5
 
+# hidden so that it is not picked up as a label file when globbing path_out
+MANIFEST_FILENAME = ".convert_manifest.json"
 
-def find_path_3d(paths_3d: [], task_name: str):
-    for path in paths_3d:
-        cur_base_name = os.path.basename(path)
-        # logger.info(f"cur_base_name: {cur_base_name}")
-        if cur_base_name == task_name:
-            return path
 
+def index_by_basename(paths: list) -> dict:
+    """
+    :return: a dictionary with key=basename value=path. The first path wins for duplicate basenames.
+    """
+    paths_by_basename = dict()
+    for path in paths:
+        paths_by_basename.setdefault(os.path.basename(path), path)
+    return paths_by_basename
+
+
+def build_task_index(files_2d: list, folders_3d: list, files_meta: list, files_imu: list):
+    """
+    map every task to its input paths once so that no lookup has to scan the globbed lists.
+    Task names are read from the <meta> block of the 2D files.
+    :return: (a dictionary with key=task name value={"path_2d", "path_3d", "path_meta", "path_imu"},
+              a list of 2D files whose task name was already indexed)
+    """
+    folders_3d_by_name = index_by_basename(folders_3d)
+    files_meta_by_name = index_by_basename(files_meta)
+    files_imu_by_name = index_by_basename(files_imu)
+
+    task_index = dict()
+    duplicate_files_2d = []
+    cvat_reader = CVATReader()
+    for file_2d in files_2d:
+        meta_data = cvat_reader.parse_meta(file_2d)
+        task_name = utils.get_dict_value(meta_data, "task/name") if meta_data else None
+        if not task_name:
+            task_name = os.path.basename(os.path.dirname(file_2d))
+            logger.error(f"ERROR: task name not found in {file_2d}, using {task_name}")
+
+        if task_name in task_index:
+            logger.error(f"ERROR: {file_2d} has the same task name {task_name} as {task_index[task_name]['path_2d']}")
+            duplicate_files_2d.append(file_2d)
+            continue
 
-def load_csv_files(paths: [], task_name: str, data_type="Meta", columns=METADATA_COLUMNS):
-    metadata_path = None
+        task_index[task_name] = {
+            "path_2d": file_2d,
+            "path_3d": folders_3d_by_name.get(task_name),
+            "path_meta": files_meta_by_name.get(task_name + "Meta.csv"),
+            "path_imu": files_imu_by_name.get(task_name + "IMU.csv")
+        }
+
+    return task_index, duplicate_files_2d
+
+
+def report_incomplete_tasks(task_index: dict):
+    for task_name, task_paths in task_index.items():
+        missing = [data_type for data_type, key in [("3D", "path_3d"), ("Meta", "path_meta"), ("IMU", "path_imu")]
+                   if not task_paths[key]]
+        if missing:
+            logger.error(f"ERROR: {task_name} is missing {', '.join(missing)}")
+
+
+def _stat_fingerprint(paths: list, root=None) -> str:
+    stats = []
     for path in paths:
-        cur_base_name = os.path.basename(path)
-        # logger.info(f"cur_base_name: {cur_base_name}")
-        if cur_base_name == task_name + data_type + ".csv":
-            metadata_path = path
-            break
+        stat = os.stat(path)
+        name = os.path.relpath(path, root) if root else path
+        stats.append([name, stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps(stats).encode("utf-8")).hexdigest()
+
 
-    if metadata_path:
+def fingerprint_task(task_paths: dict, output_options: dict) -> dict:
+    """
+    fingerprint the inputs of a task by file size and modification time
+    :param task_paths: an entry of build_task_index
+    :param output_options: options that change the output files so that changing them triggers a rebuild
+    :return: a dictionary with key=input type value=fingerprint or None if the input is missing
+    """
+    fingerprint = dict()
+    fingerprint["options"] = output_options
+    for key in ["path_2d", "path_meta", "path_imu"]:
+        path = task_paths[key]
+        fingerprint[key] = _stat_fingerprint([path]) if path else None
+
+    path_3d = task_paths["path_3d"]
+    fingerprint["path_3d"] = None
+    if path_3d:
+        files_3d = sorted(os.path.join(root, file) for root, _, files in os.walk(path_3d) for file in files)
+        fingerprint["path_3d"] = _stat_fingerprint(files_3d, root=path_3d)
+
+    return fingerprint
+
+
+def load_csv_file(csv_path: str, columns=METADATA_COLUMNS):
+    if csv_path:
         csv_reader = Project85CsvReader()
         csv_reader.columns = columns
-        metadata_dict = csv_reader.parse([metadata_path])
+        metadata_dict = csv_reader.parse([csv_path])
         # logger.info(metadata_dict)
-        return metadata_dict[task_name + data_type + ".csv"]
+        return metadata_dict[os.path.basename(csv_path)]
+
+
+def convert_task(task_paths: dict, path_out: str, writer_threads: int = 0, compact_json: bool = False,
+                 raw_cuboids: bool = False, validate_cuboids: bool = False, sink=None):
+    """
+    convert a single CVAT task
+    :param task_paths: an entry of build_task_index
+    :param sink: output sink shared by all tasks, e.g., an archive. Written to path_out if not given
+    :return: (error count, task name if its 3D path is missing else None)
+    """
+    file_2d = task_paths["path_2d"]
+    logger.info(f"Processing {file_2d}")
+    cvat_reader = CVATReader()
+    data_labels = cvat_reader.read_data_labels(file_2d)
+
+    task_name = data_labels.meta_data["task"]["name"]
+    logger.info(f"task_name: {task_name}")
 
+    task_path_3d = task_paths["path_3d"]
+    logger.info(f"Found 3D path: {task_path_3d}")
+    if not task_path_3d:
+        logger.error(f"ERROR: 3D path not found {task_path_3d}")
+        return 1, task_name
 
-def convert_project85_labels(path_2d: str, path_3d: str, path_meta: str, path_imu: str, path_out: str):
+    metadata_dict = load_csv_file(task_paths["path_meta"], columns=METADATA_COLUMNS)
+    if not metadata_dict:
+        logger.error(f"ERROR: Meta data not loaded properly")
+        return 1, None
+    # logger.info(metadata_dict)
+    imu_dict = load_csv_file(task_paths["path_imu"], columns=IMU_COLUMNS)
+    if not imu_dict:
+        logger.error(f"ERROR: IMU data not loaded properly")
+        return 1, None
+    # logger.info(imu_dict)
+
+    if validate_cuboids:
+        invalid_cuboid_files = Project85Writer.validate_cuboid_files(task_path_3d)
+        if invalid_cuboid_files:
+            logger.error(f"ERROR: {len(invalid_cuboid_files)} invalid cuboid files in {task_path_3d}")
+            return 1, None
+
+    p85_writer = Project85Writer()
+    p85_writer.write_85(data_labels, task_path_3d, metadata_dict, imu_dict, path_out,
+                        writer_threads=writer_threads, compact=compact_json, raw_cuboids=raw_cuboids, sink=sink)
+    logger.info(f"Finished {task_name}")
+    return 0, None
+
+
+def _report_results(files_2d: list, duplicate_files_2d: list, results: list):
+    """
+    :param results: (error count, missing 3D task name) of every converted task
+    """
+    errors = len(duplicate_files_2d)
+    missing_3d_paths = []
+    for task_errors, missing_3d_task in results:
+        errors += task_errors
+        if missing_3d_task:
+            missing_3d_paths.append(missing_3d_task)
+
+    logger.info(f"All finished {len(files_2d)} with {errors} errors")
+    if len(missing_3d_paths) > 0:
+        logger.error(f"Missing 3d path tasks are: {missing_3d_paths}")
+
+    if errors > 0:
+        logger.error(f"ERROR: encountered {errors} total errors")
+
+    logger.info(f"Finished converting {len(files_2d)} 2D files")
+
+
+def convert_project85_labels(path_2d: str, path_3d: str, path_meta: str, path_imu: str, path_out: str,
+                             workers: int = 1, writer_threads: int = 0, incremental: bool = False,
+                             compact_json: bool = False, raw_cuboids: bool = False, validate_cuboids: bool = False,
+                             compression_level: int = None):
+    """
+    :param path_out: output folder, or a .zip, .tar, .tar.gz or .tgz file to write the converted files
+        straight into an archive with the same folder layout
+    :param incremental: skip the tasks whose inputs are unchanged since the last run according to
+        the manifest in path_out
+    :param compact_json: write the output JSON files without indentation
+    :param raw_cuboids: copy the cuboid files into the output as they are instead of parsing them
+    :param validate_cuboids: check that the cuboid files of a task are valid JSON before converting it
+    :param compression_level: 0 to 9 compression level of the archive
+    """
 
     logger.info(f"2D: {path_2d} 3D: {path_3d} Meta: {path_meta} IMU: {path_imu} Out: {path_out}")
     files_2d = utils.glob_files_all(path_2d, file_type="*.xml")
@@ -70,53 +226,68 @@ def convert_project85_labels(path_2d: str, path_3d: str, path_meta: str, path_im
     files_imu = utils.glob_files_all(path_imu, file_type="*.csv")
     logger.info(f"Found {len(files_imu)} IMU files")
 
+    task_index, duplicate_files_2d = build_task_index(files_2d, folders_3d, files_meta, files_imu)
+    logger.info(f"Indexed {len(task_index)} tasks")
+    report_incomplete_tasks(task_index)
+
+    if is_archive(path_out):
+        # all tasks are written into a single archive by this process
+        if workers > 1 or incremental:
+            logger.error(f"ERROR: --workers and --incremental are not supported when writing to an archive {path_out}")
+            return
+
+        with create_output_sink(path_out, compression_level) as sink:
+            convert = functools.partial(convert_task, path_out=path_out, writer_threads=writer_threads,
+                                        compact_json=compact_json, raw_cuboids=raw_cuboids,
+                                        validate_cuboids=validate_cuboids, sink=sink)
+            results = list(map(convert, task_index.values()))
+        _report_results(files_2d, duplicate_files_2d, results)
+        return
+
     if not os.path.exists(path_out):
         os.mkdir(path_out)
 
-    errors = 0
-    missing_3d_paths = []
-    for file_2d in files_2d:
-        logger.info(f"Processing {file_2d}")
-        cvat_reader = CVATReader()
-        parsed_dict = cvat_reader.parse([file_2d])
-        data_labels = DataLabels.from_adq_labels(AdqLabels.from_json(parsed_dict))
-
-        task_name = data_labels.meta_data["task"]["name"]
-        logger.info(f"task_name: {task_name}")
-
-        task_path_3d = find_path_3d(folders_3d, task_name)
-        logger.info(f"Found 3D path: {task_path_3d}")
-        if not task_path_3d:
-            logger.error(f"ERROR: 3D path not found {task_path_3d}")
-            missing_3d_paths.append(task_name)
-            errors += 1
-            continue
+    # the manifest records the input fingerprints of every task converted without errors
+    manifest_filename = os.path.join(path_out, MANIFEST_FILENAME)
+    manifest = utils.from_file(manifest_filename) if incremental else dict()
 
-        metadata_dict = load_csv_files(files_meta, task_name, data_type="Meta", columns=METADATA_COLUMNS)
-        if not metadata_dict:
-            logger.error(f"ERROR: Meta data not loaded properly")
-            errors += 1
-            continue
-        # logger.info(metadata_dict)
-        imu_dict = load_csv_files(files_imu, task_name, data_type="IMU", columns=IMU_COLUMNS)
-        if not imu_dict:
-            logger.error(f"ERROR: IMU data not loaded properly")
-            errors += 1
-            continue
-        # logger.info(imu_dict)
+    output_options = {"compact_json": compact_json, "raw_cuboids": raw_cuboids}
+    task_fingerprints = {task_name: fingerprint_task(task_paths, output_options)
+                         for task_name, task_paths in task_index.items()}
+    tasks_to_convert = []
+    skipped_tasks = []
+    for task_name, task_paths in task_index.items():
+        if incremental and manifest.get(task_name) == task_fingerprints[task_name] and \
+                os.path.isdir(os.path.join(path_out, task_name)):
+            skipped_tasks.append(task_name)
+        else:
+            tasks_to_convert.append(task_name)
+    if incremental:
+        logger.info(f"Skipping {len(skipped_tasks)} unchanged tasks, converting {len(tasks_to_convert)} tasks")
 
-        p85_writer = Project85Writer()
-        p85_writer.write_85(data_labels, task_path_3d, metadata_dict, imu_dict, path_out)
-        logger.info(f"Finished {task_name}")
+    convert = functools.partial(convert_task, path_out=path_out, writer_threads=writer_threads,
+                                compact_json=compact_json, raw_cuboids=raw_cuboids,
+                                validate_cuboids=validate_cuboids)
+    task_paths_to_convert = [task_index[task_name] for task_name in tasks_to_convert]
+    if workers > 1:
+        logger.info(f"Converting with {workers} worker processes")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(convert, task_paths_to_convert))
+    else:
+        results = map(convert, task_paths_to_convert)
 
-    logger.info(f"All finished {len(files_2d)} with {errors} errors")
-    if len(missing_3d_paths) > 0:
-        logger.error(f"Missing 3d path tasks are: {missing_3d_paths}")
+    # merge the per task results in the order of files_2d
+    results = list(results)
+    for task_name, (task_errors, _) in zip(tasks_to_convert, results):
+        if task_errors == 0:
+            manifest[task_name] = task_fingerprints[task_name]
+        else:
+            manifest.pop(task_name, None)
 
-    if errors > 0:
-        logger.error(f"ERROR: encountered {errors} total errors")
+    json_data = serializer.dumps(manifest)
+    utils.to_file(json_data, manifest_filename)
 
-    logger.info(f"Finished converting {len(files_2d)} 2D files")
+    _report_results(files_2d, duplicate_files_2d, results)
 
 
 if __name__ == '__main__':
@@ -126,9 +297,27 @@ if __name__ == '__main__':
     parser.add_argument("--path_meta", action="store", dest="path_meta", type=str)
     parser.add_argument("--path_imu", action="store", dest="path_imu", type=str)
     parser.add_argument("--path_out", action="store", dest="path_out", type=str)
+    parser.add_argument("--workers", action="store", dest="workers", type=int, default=1,
+                        help="number of worker processes converting tasks in parallel")
+    parser.add_argument("--writer_threads", action="store", dest="writer_threads", type=int, default=0,
+                        help="number of threads writing the output JSON files of a task")
+    parser.add_argument("--incremental", action="store_true", dest="incremental",
+                        help="only convert the tasks whose inputs changed since the last run")
+    parser.add_argument("--compact_json", action="store_true", dest="compact_json",
+                        help="write the output JSON files without indentation")
+    parser.add_argument("--raw_cuboids", action="store_true", dest="raw_cuboids",
+                        help="copy the 3D cuboid files into the output as they are without parsing them")
+    parser.add_argument("--validate_cuboids", action="store_true", dest="validate_cuboids",
+                        help="check that the 3D cuboid files are valid JSON before converting a task")
+    parser.add_argument("--compression_level", action="store", dest="compression_level", type=int, default=None,
+                        help="0 to 9 compression level when path_out is a .zip, .tar.gz or .tgz archive")
 
     args = parser.parse_args()
 
     if not args.path_out:
         args.path_out = os.path.join(".", "85out")
-    convert_project85_labels(args.path_2d, args.path_3d, args.path_meta, args.path_imu, args.path_out)
+    convert_project85_labels(args.path_2d, args.path_3d, args.path_meta, args.path_imu, args.path_out,
+                             workers=args.workers, writer_threads=args.writer_threads,
+                             incremental=args.incremental, compact_json=args.compact_json,
+                             raw_cuboids=args.raw_cuboids, validate_cuboids=args.validate_cuboids,
+                             compression_level=args.compression_level)
@@ -1,9 +1,10 @@
 import argparse
 import os.path
-import shutil as shutil
+from concurrent.futures import ThreadPoolExecutor
 
 import src.common.utils as utils
 from src.common.logger import get_logger
+from src.common.output_sink import COPY, PLACEMENT_MODES, create_output_sink
 
 logger = get_logger(__name__)
 
@@ -50,45 +51,66 @@ FOLDER_MAP = {
 }
 
 
-def create_folders(path_in: str, path_out: str):
-    label_files = utils.glob_files_all(path_in, file_type="*.json")
-    logger.info(f"Found {len(label_files)} label_files")
+def get_destination_file(label_file: str) -> str:
+    """
+    :return: the relative path of label_file in the folder hierarchy of FOLDER_MAP
+    """
+    parent_folder = os.path.basename(os.path.dirname(label_file))
+    tokens = parent_folder.replace("_1_", "").replace("_2_", "").split('_')
+    # logger.info(tokens)
+
+    folders = []
+    for token in tokens:
+        folder = FOLDER_MAP.get(token)
+        if not folder:
+            logger.error(f"Can't find file mapping for {token} {tokens} in {label_file}")
 
-    out_dir = path_out
-    if out_dir and not os.path.exists(out_dir):
-        os.mkdir(out_dir)
+        folders.append(folder)
 
-    for idx, label_file in enumerate(label_files):
-        parent_folder = os.path.basename(os.path.dirname(label_file))
-        tokens = parent_folder.replace("_1_", "").replace("_2_", "").split('_')
-        # logger.info(tokens)
+    folders.append(parent_folder.rstrip('_'))
+    return "/".join(folders + [os.path.basename(label_file)])
 
-        out_sub_dir = out_dir
-        for token in tokens:
-            folder = FOLDER_MAP.get(token)
-            if not folder:
-                logger.error(f"Can't find file mapping for {token} {tokens} in {label_file}")
 
-            out_sub_dir = os.path.join(out_sub_dir, folder)
-            if not os.path.exists(out_sub_dir):
-                os.mkdir(out_sub_dir)
+def create_folders(path_in: str, path_out: str, compression_level: int = None, mode: str = COPY,
+                   threads: int = 0):
+    """
+    :param path_out: output folder, or a .zip, .tar, .tar.gz or .tgz file to copy the label files
+        straight into an archive with the same folder layout
+    :param compression_level: 0 to 9 compression level of the archive
+    :param mode: copy, hardlink, symlink or move the label files. Archives only support copy
+    :param threads: if > 0, place the files in a pool of threads
+    """
+    label_files = utils.glob_files_all(path_in, file_type="*.json")
+    logger.info(f"Found {len(label_files)} label_files")
+
+    destination_files = [get_destination_file(label_file) for label_file in label_files]
 
-        out_sub_dir = os.path.join(out_sub_dir, parent_folder.rstrip('_'))
-        if not os.path.exists(out_sub_dir):
-            os.mkdir(out_sub_dir)
+    with create_output_sink(path_out, compression_level, placement=mode) as sink:
+        def _place_file(idx):
+            logger.info(f"Placing ({mode}) {idx+1}/{len(label_files)} {label_files[idx]} to {destination_files[idx]}")
+            sink.add_file(label_files[idx], destination_files[idx])
 
-        destination_file = os.path.join(out_sub_dir, os.path.basename(label_file))
-        logger.info(f"Copying {idx+1}/{len(label_files)} {label_file} to {destination_file}")
-        shutil.copy(label_file, destination_file)
+        if threads > 0:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(_place_file, range(len(label_files))))
+        else:
+            for idx in range(len(label_files)):
+                _place_file(idx)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--path_in", action="store", dest="path_in", type=str)
     parser.add_argument("--path_out", action="store", dest="path_out", type=str)
+    parser.add_argument("--compression_level", action="store", dest="compression_level", type=int, default=None,
+                        help="0 to 9 compression level when path_out is a .zip, .tar.gz or .tgz archive")
+    parser.add_argument("--mode", action="store", dest="mode", type=str, default=COPY, choices=PLACEMENT_MODES,
+                        help="how to place the label files in the output folder")
+    parser.add_argument("--threads", action="store", dest="threads", type=int, default=0,
+                        help="number of threads placing the label files")
 
     args = parser.parse_args()
 
     if not args.path_out:
         args.path_out = os.path.join(".", "verify85")
-    create_folders(args.path_in, args.path_out)
+    create_folders(args.path_in, args.path_out, args.compression_level, mode=args.mode, threads=args.threads)
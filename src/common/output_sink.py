@@ -0,0 +1,148 @@
+import io
+import os
+import shutil
+import tarfile
+import threading
+import time
+import zipfile
+
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+"""
+Output sinks write converted files either into a folder or straight into a zip/tar archive.
+Files are addressed by their relative path (arcname) so that the layout is the same for every sink.
+"""
+
+ZIP_EXTENSIONS = (".zip",)
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz")
+
+# how FolderSink.add_file places an existing file. Archives always copy
+COPY = "copy"
+HARDLINK = "hardlink"
+SYMLINK = "symlink"
+MOVE = "move"
+PLACEMENT_MODES = [COPY, HARDLINK, SYMLINK, MOVE]
+
+
+class FolderSink:
+    def __init__(self, path_out: str, placement: str = COPY):
+        """
+        :param placement: one of PLACEMENT_MODES for add_file
+        """
+        if placement not in PLACEMENT_MODES:
+            raise ValueError(f"Unknown placement mode {placement}. Supported modes are {PLACEMENT_MODES}")
+        self.path_out = path_out
+        self.placement = placement
+        # folders already created so that makedirs is called once per folder
+        self.folders = set()
+
+    def _get_path(self, arcname: str) -> str:
+        path = os.path.join(self.path_out, *arcname.split('/'))
+        folder = os.path.dirname(path)
+        if folder not in self.folders:
+            os.makedirs(folder, exist_ok=True)
+            self.folders.add(folder)
+        return path
+
+    def write(self, arcname: str, data: str):
+        with open(self._get_path(arcname), 'w', encoding="utf-8") as file:
+            file.write(data)
+
+    def add_file(self, filename: str, arcname: str):
+        destination = self._get_path(arcname)
+        # remove the file of a previous run first. Links can't overwrite, copying onto a hardlink of the source
+        # fails and copying onto a symlink would write through it into the source
+        if os.path.lexists(destination):
+            os.remove(destination)
+        if self.placement == MOVE:
+            shutil.move(filename, destination)
+            return
+        if self.placement == COPY:
+            shutil.copy(filename, destination)
+            return
+        if self.placement == SYMLINK:
+            os.symlink(os.path.abspath(filename), destination)
+            return
+        try:
+            os.link(filename, destination)
+        except OSError as e:
+            # e.g., a different file system
+            logger.warning(f"Can't hardlink {filename} to {destination}, copying it instead: {e}")
+            shutil.copy(filename, destination)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ZipSink(FolderSink):
+    def __init__(self, path_out: str, compression_level: int = None):
+        super().__init__(path_out)
+        self.zip_file = zipfile.ZipFile(path_out, 'w', zipfile.ZIP_DEFLATED, compresslevel=compression_level)
+        # entries are written by several writer threads
+        self.lock = threading.Lock()
+
+    def write(self, arcname: str, data: str):
+        with self.lock:
+            self.zip_file.writestr(arcname, data)
+
+    def add_file(self, filename: str, arcname: str):
+        with self.lock:
+            self.zip_file.write(filename, arcname)
+
+    def close(self):
+        self.zip_file.close()
+
+
+class TarSink(FolderSink):
+    def __init__(self, path_out: str, compression_level: int = None):
+        super().__init__(path_out)
+        if path_out.lower().endswith(".tar"):
+            self.tar_file = tarfile.open(path_out, 'w')
+        else:
+            self.tar_file = tarfile.open(path_out, 'w:gz',
+                                         compresslevel=9 if compression_level is None else compression_level)
+        self.lock = threading.Lock()
+
+    def write(self, arcname: str, data: str):
+        data = data.encode("utf-8")
+        tar_info = tarfile.TarInfo(arcname)
+        tar_info.size = len(data)
+        tar_info.mtime = int(time.time())
+        with self.lock:
+            self.tar_file.addfile(tar_info, io.BytesIO(data))
+
+    def add_file(self, filename: str, arcname: str):
+        with self.lock:
+            self.tar_file.add(filename, arcname)
+
+    def close(self):
+        self.tar_file.close()
+
+
+def is_archive(path_out: str) -> bool:
+    return path_out.lower().endswith(ZIP_EXTENSIONS + TAR_EXTENSIONS)
+
+
+def create_output_sink(path_out: str, compression_level: int = None, placement: str = COPY):
+    """
+    :param path_out: a folder, or a .zip, .tar, .tar.gz or .tgz file to write an archive
+    :param compression_level: 0 (none) to 9 (best). Ignored for folders and .tar files
+    :param placement: one of PLACEMENT_MODES. Only folders support modes other than copy
+    """
+    if placement != COPY and is_archive(path_out):
+        raise ValueError(f"Placement mode {placement} is not supported for the archive {path_out}")
+
+    path_lower = path_out.lower()
+    if path_lower.endswith(ZIP_EXTENSIONS):
+        return ZipSink(path_out, compression_level)
+    if path_lower.endswith(TAR_EXTENSIONS):
+        return TarSink(path_out, compression_level)
+    return FolderSink(path_out, placement)
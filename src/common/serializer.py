@@ -0,0 +1,98 @@
+import json
+import os
+
+"""
+JSON serializer backend.
+The standard library is the default so that the output does not depend on the installed packages.
+orjson or ujson are much faster and can be selected with the LABEL_CONVERTER_JSON_BACKEND environment variable
+or set_backend(). Their output differs from the standard library:
+- orjson can't load NaN or Infinity and writes them as null
+- floats are formatted differently, e.g., 1e-7 instead of 1e-07 and 1e16 instead of 1e+16
+"""
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+ORJSON = "orjson"
+UJSON = "ujson"
+STDLIB_JSON = "json"
+
+SUPPORTED_BACKENDS = [ORJSON, UJSON, STDLIB_JSON]
+
+_backend = None
+
+
+def default(obj):
+    if hasattr(obj, 'to_json'):
+        return obj.to_json()
+    raise TypeError(f'Object of type {obj.__class__.__name__} is not JSON serializable')
+
+
+def get_available_backends() -> list:
+    available = []
+    if orjson:
+        available.append(ORJSON)
+    if ujson:
+        available.append(UJSON)
+    available.append(STDLIB_JSON)
+    return available
+
+
+def set_backend(backend: str = None):
+    """
+    :param backend: one of SUPPORTED_BACKENDS or None for the standard library
+    """
+    global _backend
+    available = get_available_backends()
+    if backend is None:
+        backend = STDLIB_JSON
+    if backend not in available:
+        raise ValueError(f"JSON backend {backend} is not available. Available backends are {available}")
+    _backend = backend
+
+
+def get_backend() -> str:
+    if _backend is None:
+        set_backend(os.environ.get("LABEL_CONVERTER_JSON_BACKEND") or None)
+    return _backend
+
+
+def dumps(obj, compact=False) -> str:
+    """
+    :param obj: object to serialize. Objects with to_json() are serialized through it
+    :param compact: no indentation or spaces for machine consumers. Pretty-printed with indent=2 otherwise
+    :return: JSON string with non-ASCII characters kept as they are
+    """
+    backend = get_backend()
+    if backend == ORJSON:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if not compact:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=default, option=option).decode("utf-8")
+
+    if backend == UJSON:
+        return ujson.dumps(obj, default=default, ensure_ascii=False, escape_forward_slashes=False,
+                           indent=0 if compact else 2)
+
+    if compact:
+        return json.dumps(obj, default=default, ensure_ascii=False, separators=(",", ":"))
+    return json.dumps(obj, default=default, ensure_ascii=False, indent=2)
+
+
+def loads(data):
+    """
+    :param data: JSON str or bytes
+    """
+    backend = get_backend()
+    if backend == ORJSON:
+        return orjson.loads(data)
+    if backend == UJSON:
+        return ujson.loads(data)
+    return json.loads(data)
@@ -1,24 +1,27 @@
 import glob
-import json
 import os
+import time
 import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import chardet
 
+import src.common.serializer as serializer
+from src.common.logger import get_logger
+from src.common.serializer import default
 
-def default(obj):
-    if hasattr(obj, 'to_json'):
-        return obj.to_json()
-    raise TypeError(f'Object of type {obj.__class__.__name__} is not JSON serializable')
+logger = get_logger(__name__)
 
 
 def from_file(filename, default_json="{}"):
     if os.path.exists(filename) and os.path.getsize(filename) > 0:
-        file = open(filename, 'r', encoding='utf-8')
-        return json.load(file)
+        with open(filename, 'rb') as file:
+            return serializer.loads(file.read())
 
-    return json.loads(default_json)
+    return serializer.loads(default_json)
 
 
 def to_file(data, filename):
@@ -109,14 +112,124 @@ def get_dict_value(meta_data_dict: dict, search_str: str):
     return cur_dict
 
 
+# already compressed assets that are stored as they are instead of being deflated again
+STORED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".pcd", ".zip", ".gz", ".tgz", ".mp4")
+
+# log the zip progress every this many files
+ZIP_PROGRESS_INTERVAL = 1000
+
+
+# files larger than this are compressed while they are written instead of in the pool of threads
+# so that at most 2 * threads of them are held in memory
+ZIP_PRECOMPRESS_MAX_SIZE = 16 * 1024 * 1024
+
+
+def _deflate_file(file_path: str, compression_level: int):
+    """
+    compress a file the way zipfile does for ZIP_DEFLATED entries
+    :return: (uncompressed size, CRC-32, raw deflate data)
+    """
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -15)
+    return len(data), zlib.crc32(data), compressor.compress(data) + compressor.flush()
+
+
+def _write_deflated(zipf: zipfile.ZipFile, file_path: str, arcname: str, deflated: tuple):
+    """
+    append an entry that has already been compressed by _deflate_file.
+    zipfile has no public API for compressed data so this relies on its internals and is only used by
+    the threaded zip_folder
+    """
+    file_size, crc, compressed = deflated
+    zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(compressed)
+    zinfo.CRC = crc
+
+    zipf._writecheck(zinfo)
+    zipf._didModify = True
+    zinfo.header_offset = zipf.fp.tell()
+    zipf.fp.write(zinfo.FileHeader())
+    zipf.fp.write(compressed)
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[zinfo.filename] = zinfo
+    zipf.start_dir = zipf.fp.tell()
+
+
 # Function to zip a folder
-def zip_folder(folder_path, zip_filename):
-    with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, folder_path)
-                zipf.write(file_path, arcname)
+def zip_folder(folder_path, zip_filename, compression_level: int = None, threads: int = 0,
+               stored_extensions=STORED_EXTENSIONS) -> dict:
+    """
+    :param compression_level: 0 (none) to 9 (best) deflate level. zlib default if None
+    :param threads: if > 0, deflate the files up to ZIP_PRECOMPRESS_MAX_SIZE in a pool of threads
+        while the entries are written in order. The archive is the same as zipping sequentially.
+    :param stored_extensions: files with these extensions are stored without compression
+    :return: a summary with the number of files, the uncompressed and compressed bytes and the elapsed seconds
+    """
+    if compression_level is None:
+        compression_level = zlib.Z_DEFAULT_COMPRESSION
+
+    file_paths = sorted(os.path.join(root, file) for root, _, files in os.walk(folder_path) for file in files)
+    logger.info(f"Zipping {len(file_paths)} files in {folder_path} to {zip_filename}")
+
+    start_time = time.perf_counter()
+    executor = None
+    if threads > 0:
+        executor = ThreadPoolExecutor(max_workers=threads)
+
+    def _write_entry(file_path, is_stored, deflated=None):
+        """
+        :param deflated: future of _deflate_file or None to let zipfile compress the file
+        """
+        arcname = os.path.relpath(file_path, folder_path)
+        if is_stored:
+            zipf.write(file_path, arcname, compress_type=zipfile.ZIP_STORED)
+        elif deflated is None:
+            zipf.write(file_path, arcname, compress_type=zipfile.ZIP_DEFLATED, compresslevel=compression_level)
+        else:
+            _write_deflated(zipf, file_path, arcname, deflated.result())
+
+        written = len(zipf.filelist)
+        if written % ZIP_PROGRESS_INTERVAL == 0:
+            logger.info(f"\tZipped {written}/{len(file_paths)} files")
+
+    try:
+        with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            # files in flight: (file path, is stored, deflate future or None)
+            pending_entries = deque()
+            for file_path in file_paths:
+                is_stored = file_path.lower().endswith(stored_extensions)
+                if not executor:
+                    _write_entry(file_path, is_stored)
+                    continue
+
+                deflated = None
+                if not is_stored and os.path.getsize(file_path) <= ZIP_PRECOMPRESS_MAX_SIZE:
+                    # keep at most 2 files per thread in memory
+                    while len(pending_entries) >= 2 * threads:
+                        _write_entry(*pending_entries.popleft())
+                    deflated = executor.submit(_deflate_file, file_path, compression_level)
+                pending_entries.append((file_path, is_stored, deflated))
+
+            while pending_entries:
+                _write_entry(*pending_entries.popleft())
+
+            summary = {
+                "files": len(zipf.filelist),
+                "bytes": sum(zinfo.file_size for zinfo in zipf.filelist),
+                "compressed_bytes": sum(zinfo.compress_size for zinfo in zipf.filelist)
+            }
+    finally:
+        if executor:
+            executor.shutdown()
+
+    summary["seconds"] = time.perf_counter() - start_time
+    ratio = summary["compressed_bytes"] / summary["bytes"] if summary["bytes"] else 1
+    logger.info(f"Zipped {summary['files']} files {summary['bytes']} bytes to {summary['compressed_bytes']} bytes "
+                f"({ratio:.1%}) in {summary['seconds']:.1f}s")
+    return summary
 
 
 def get_encoding(file_path: str):
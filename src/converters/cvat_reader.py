@@ -1,9 +1,17 @@
 import xml.etree.ElementTree as ET
+from itertools import chain
 
 import src.common.utils as utils
-from .base_reader import BaseReader
+import src.models.label_snapshot as label_snapshot
+from src.models.data_labels import DataLabels
+from .base_reader import BaseReader, CONVERT_ID, CONVERT_VERSION
 
 BO_SHAPE_TYPES = ['box', 'polygon', 'polyline', 'points', 'face', 'body', 'leftHand', 'rightHand']
+# key: shape tag, value: position in BO_SHAPE_TYPES
+BO_SHAPE_TYPE_ORDER = {shape_type: idx for idx, shape_type in enumerate(BO_SHAPE_TYPES)}
+
+# snapshot kind of the files read by CVATReader.read_data_labels
+CVAT_SNAPSHOT = "cvat"
 
 
 class CVATReader(BaseReader):
@@ -23,6 +31,116 @@ class CVATReader(BaseReader):
                 result[child.tag] = child_data
         return result
 
+    @staticmethod
+    def convert_shapes(el_image, convert_object) -> list:
+        """
+        scan the children of <image> once, dispatching each shape on its tag through BO_SHAPE_TYPE_ORDER.
+        The result is grouped in BO_SHAPE_TYPES order and keeps document order within each type,
+        which is the same order as calling findall once per shape type.
+        :param el_image: <image> element
+        :param convert_object: function(el_object, object_type) returning the converted object
+        :return: a list of converted objects
+        """
+        converted_by_type = [[] for _ in BO_SHAPE_TYPES]
+        for el_child in el_image:
+            type_idx = BO_SHAPE_TYPE_ORDER.get(el_child.tag)
+            if type_idx is not None:
+                converted_by_type[type_idx].append(convert_object(el_child, BO_SHAPE_TYPES[type_idx]))
+
+        return list(chain.from_iterable(converted_by_type))
+
+    def _parse_object(self, el_object, object_type):
+        object_dict = dict()
+        object_dict['label'] = el_object.attrib['label']
+        object_dict['type'] = object_type
+
+        try:
+            object_dict['occluded'] = el_object.attrib['occluded']
+        except KeyError:
+            object_dict['occluded'] = "0"
+
+        try:
+            object_dict['z_order'] = el_object.attrib['z_order']
+        except KeyError:
+            object_dict['z_order'] = "0"
+
+        try:
+            object_dict['group_id'] = el_object.attrib['group_id']
+        except KeyError:
+            object_dict['group_id'] = ""
+
+        if object_type == 'box':
+            object_dict['position'] = "{}, {}, {}, {}".format(el_object.attrib['xtl'],
+                                                              el_object.attrib['ytl'],
+                                                              el_object.attrib['xbr'],
+                                                              el_object.attrib['ybr'])
+        else:
+            object_dict['position'] = el_object.attrib['points']
+
+        attributes = list()
+        el_attributes = el_object.findall('attribute')
+        for each_attr in el_attributes:
+            attributes_dict = dict()
+            attributes_dict['attribute_name'] = each_attr.attrib['name']
+            attributes_dict['attribute_value'] = each_attr.text
+            attributes.append(attributes_dict)
+
+        object_dict['attributes'] = attributes
+        return object_dict
+
+    def _parse_image(self, el_image):
+        image_dict = dict()
+        image_dict['image_id'] = el_image.attrib['id']
+        image_dict['name'] = el_image.attrib['name']
+        image_dict['width'] = el_image.attrib['width']
+        image_dict['height'] = el_image.attrib['height']
+
+        image_dict['objects'] = self.convert_shapes(el_image, self._parse_object)
+        return image_dict
+
+    @staticmethod
+    def _parse_points(points_str: str) -> list:
+        """
+        :param points_str: CVAT points attribute "x1,y1;x2,y2;..."
+        :return: [[x1, y1], [x2, y2], ...]
+        """
+        return [[float(value) for value in point.split(',')] for point in points_str.split(';') if point]
+
+    def _create_object(self, el_object, object_type) -> DataLabels.Object:
+        """
+        build DataLabels.Object straight from the XML attributes so that coordinates are parsed only once
+        """
+        attrib = el_object.attrib
+        if object_type == 'box':
+            points = [[float(attrib['xtl']), float(attrib['ytl']), float(attrib['xbr']), float(attrib['ybr'])]]
+        else:
+            points = self._parse_points(attrib['points'])
+
+        # same defaults as DataLabels.Object.from_adq_object
+        group_id = attrib.get('group_id')
+        attributes = dict()
+        attributes['occluded'] = int(attrib.get('occluded', "0")) if group_id else 0
+        attributes['z_order'] = int(attrib.get('z_order', "0")) if group_id else 0
+        attributes['group_id'] = int(group_id) if group_id else 0
+
+        for each_attr in el_object.findall('attribute'):
+            attributes[each_attr.attrib['name']] = each_attr.text
+
+        return DataLabels.Object(label=attrib['label'],
+                                 type=object_type,
+                                 points=points,
+                                 attributes=attributes)
+
+    def _create_image(self, el_image) -> DataLabels.Image:
+        objects = self.convert_shapes(el_image, self._create_object)
+
+        return DataLabels.Image(
+            image_id=el_image.attrib['id'],
+            name=el_image.attrib['name'],
+            width=int(el_image.attrib['width']),
+            height=int(el_image.attrib['height']),
+            objects=objects)
+
     def parse(self, label_files, data_files=None):
         super().parse(label_files, data_files)
 
@@ -43,56 +161,79 @@ class CVATReader(BaseReader):
             images = list()
             el_images = root_info.findall('image')
             for el_image in el_images:
-                image_dict = dict()
-                image_dict['image_id'] = el_image.attrib['id']
-                image_dict['name'] = el_image.attrib['name']
-                image_dict['width'] = el_image.attrib['width']
-                image_dict['height'] = el_image.attrib['height']
-
-                objects_list = list()
-                for object_type in BO_SHAPE_TYPES:
-                    el_objects = el_image.findall(object_type)
-                    for el_object in el_objects:
-                        object_dict = dict()
-                        object_dict['label'] = el_object.attrib['label']
-                        object_dict['type'] = object_type
-
-                        try:
-                            object_dict['occluded'] = el_object.attrib['occluded']
-                        except KeyError:
-                            object_dict['occluded'] = "0"
-
-                        try:
-                            object_dict['z_order'] = el_object.attrib['z_order']
-                        except KeyError:
-                            object_dict['z_order'] = "0"
-
-                        try:
-                            object_dict['group_id'] = el_object.attrib['group_id']
-                        except KeyError:
-                            object_dict['group_id'] = ""
-
-                        if object_type == 'box':
-                            object_dict['position'] = "{}, {}, {}, {}".format(el_object.attrib['xtl'],
-                                                                              el_object.attrib['ytl'],
-                                                                              el_object.attrib['xbr'],
-                                                                              el_object.attrib['ybr'])
-                        else:
-                            object_dict['position'] = el_object.attrib['points']
-
-                        attributes = list()
-                        el_attributes = el_object.findall('attribute')
-                        for each_attr in el_attributes:
-                            attributes_dict = dict()
-                            attributes_dict['attribute_name'] = each_attr.attrib['name']
-                            attributes_dict['attribute_value'] = each_attr.text
-                            attributes.append(attributes_dict)
-
-                        object_dict['attributes'] = attributes
-                        objects_list.append(object_dict)
-
-                image_dict['objects'] = objects_list
-                images.append(image_dict)
+                images.append(self._parse_image(el_image))
 
             self.data_labels_dict['images'] = images
         return self.data_labels_dict
+
+    def parse_meta(self, label_file):
+        """
+        parse only the <meta> block of a CVAT file without reading the images that follow it
+        :param label_file: CVAT annotations.xml
+        :return: meta data dict or None
+        """
+        for event, element in ET.iterparse(label_file, events=('start', 'end')):
+            if event == 'start':
+                if element.tag == 'image':
+                    break
+                continue
+            if element.tag == 'meta':
+                if len(element) > 0:
+                    return self._parse_element(element)
+                break
+
+        return None
+
+    def iter_images(self, label_file):
+        """
+        stream DataLabels.Image objects one at a time using iterparse.
+        Each <image> element is cleared as soon as it is converted so that peak memory
+        does not grow with the number of frames.
+        <meta> is parsed once when it is reached and kept in self.data_labels_dict['meta_data'].
+        :param label_file: CVAT annotations.xml
+        :return: generator of DataLabels.Image
+        """
+        self.data_labels_dict['meta_data'] = None
+
+        root_info = None
+        for event, element in ET.iterparse(label_file, events=('start', 'end')):
+            if event == 'start':
+                if root_info is None:
+                    root_info = element
+                    if root_info.tag != 'annotations':
+                        raise Exception(label_file + 'is not a supported CVAT format.')
+                continue
+
+            if element.tag == 'meta':
+                if len(element) > 0:
+                    self.data_labels_dict['meta_data'] = self._parse_element(element)
+                root_info.clear()
+            elif element.tag == 'image':
+                image = self._create_image(element)
+                element.clear()
+                root_info.clear()
+                yield image
+
+    def read_data_labels(self, label_file) -> DataLabels:
+        """
+        read a CVAT file straight into DataLabels through the streaming reader
+        without building the element tree, the ADQ dicts or AdqLabels in between
+        :param label_file: CVAT annotations.xml
+        :return: DataLabels. Reused from its binary snapshot if the file has not changed
+        """
+        data_labels = label_snapshot.load_snapshot(label_file, CVAT_SNAPSHOT)
+        if data_labels:
+            self.data_labels_dict['meta_data'] = data_labels.meta_data
+            return data_labels
+
+        images = list(self.iter_images(label_file))
+
+        data_labels = DataLabels(
+            twconverted=CONVERT_ID,
+            mode="annotation",
+            template_version=CONVERT_VERSION,
+            images=images,
+            meta_data=self.data_labels_dict['meta_data']
+        )
+        label_snapshot.save_snapshot(data_labels, label_file, CVAT_SNAPSHOT)
+        return data_labels
@@ -1,37 +1,115 @@
+import csv
+import math
 import os
-
-import pandas as pd
+import re
 
 from src.common.logger import get_logger
 from .base_reader import BaseReader
 
 logger = get_logger(__name__)
 
+# CSV files up to this size (e.g., Meta files) are read with the csv module instead of pandas
+SMALL_CSV_SIZE = 64 * 1024
+
+# pandas.read_csv defaults so that both paths return the same values
+NA_VALUES = frozenset(["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                       "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"])
+TRUE_VALUES = frozenset(["True", "TRUE", "true"])
+FALSE_VALUES = frozenset(["False", "FALSE", "false"])
+INT_PATTERN = re.compile(r"\s*[+-]?\d+\s*")
+FLOAT_PATTERN = re.compile(r"\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*")
+
 
 class Project85CsvReader(BaseReader):
     def __init__(self):
         super().__init__()
         self.columns = None
 
+    @staticmethod
+    def _convert_column(values: list) -> list:
+        """
+        infer the type of a column the way pandas does: int if all values are ints,
+        float if all values are numbers or missing, bool for True/False and str otherwise.
+        Missing values (None, '' and the other NA_VALUES) become NaN.
+        """
+        present = [value for value in values if value is not None and value not in NA_VALUES]
+        has_missing = len(present) < len(values)
+
+        def _convert(convert_value):
+            return [math.nan if value is None or value in NA_VALUES else convert_value(value) for value in values]
+
+        if not present:
+            return [math.nan] * len(values)
+        if all(INT_PATTERN.fullmatch(value) for value in present):
+            return _convert(float if has_missing else int)
+        if all(FLOAT_PATTERN.fullmatch(value) for value in present):
+            return _convert(float)
+        if all(value in TRUE_VALUES or value in FALSE_VALUES for value in present):
+            return _convert(lambda value: value in TRUE_VALUES)
+        return _convert(str)
+
+    def _parse_small_csv(self, csv_file):
+        """
+        read a small CSV file with the csv module and return the same as _parse_large_csv:
+        {column: value} for a single data row, {column: {row index: value}} otherwise.
+        Values are converted like pandas.read_csv with _convert_column.
+        """
+        with open(csv_file, 'r', encoding='utf-8-sig', newline='') as file:
+            rows = [row for row in csv.reader(file) if row]
+
+        columns = self.columns
+        if columns is None and rows:
+            columns = rows.pop(0)
+
+        # pad short rows the way pandas fills missing fields
+        rows = [row + [None] * (len(columns) - len(row)) for row in rows]
+
+        # types are inferred before the first row is dropped as pandas does
+        converted_columns = [self._convert_column([row[col_idx] for row in rows]) for col_idx in range(len(columns))]
+        rows = [list(row) for row in zip(*converted_columns)] if converted_columns else rows
+
+        if len(rows) > 1:
+            rows = rows[1:]
+
+        if len(rows) == 1:
+            row = rows[0]
+            # pandas squeezes a single row into one Series so ints become floats if all columns are numbers
+            column_types = {type(value) for column in converted_columns for value in column}
+            if column_types == {int, float} or column_types == {float}:
+                row = [float(value) for value in row]
+            return dict(zip(columns, row))
+
+        return {column: {idx: row[col_idx] for idx, row in enumerate(rows)}
+                for col_idx, column in enumerate(columns)}
+
+    def _parse_large_csv(self, csv_file):
+        # pandas is slow to import so it is only loaded for large files like IMU logs
+        import pandas as pd
+
+        df = pd.read_csv(csv_file, names=self.columns)
+        # logger.info(df)
+
+        if len(df) > 1:
+            df = df.drop(0, axis=0).reset_index(drop=True)
+
+        # Convert DataFrame to a dictionary with single values, not nested
+        df_dict = df.squeeze().to_dict()
+
+        # Remove the index key (0) from the dictionary
+        return {k: v for k, v in df_dict.items() if k != 0}
+
     def parse(self, csv_files, data_files=None):
         super().parse(csv_files, data_files)
 
         metadata_dict = dict()
 
         for csv_file in csv_files:
-            df = pd.read_csv(csv_file, names=self.columns)
-            # logger.info(df)
-
-            if len(df) > 1:
-                df = df.drop(0, axis=0).reset_index(drop=True)
+            if os.path.getsize(csv_file) <= SMALL_CSV_SIZE:
+                df_dict = self._parse_small_csv(csv_file)
+            else:
+                df_dict = self._parse_large_csv(csv_file)
 
             csv_filename = os.path.basename(csv_file)
-
-            # Convert DataFrame to a dictionary with single values, not nested
-            df_dict = df.squeeze().to_dict()
-
-            # Remove the index key (0) from the dictionary
-            df_dict = {k: v for k, v in df_dict.items() if k != 0}
             # Add a new dictionary entry with the filename as the key
             metadata_dict[csv_filename] = df_dict
 
@@ -1,9 +1,15 @@
-import json
+import glob
 import os.path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
+
+import src.common.serializer as serializer
 import src.common.utils as utils
 from src.common.logger import get_logger
+from src.common.output_sink import FolderSink
 from src.models.data_labels import DataLabels
 from .base_writer import BaseWriter
 
@@ -80,30 +86,73 @@ class Project85Writer(BaseWriter):
 
         return annotation
 
-    def _create_info_dict(self, description, metadata_dict: dict, imu_dict: dict):
+    @staticmethod
+    def _create_env_dict(metadata_dict: dict, interaction_start_time, interaction_end_time):
+        env_dict = dict()
+        env_dict["site"] = metadata_dict["site"]
+        env_dict["location"] = metadata_dict["location"]
+        env_dict["date"] = metadata_dict["date"]
+        env_dict["weather"] = metadata_dict["weather"]
+        env_dict["temperature"] = float(metadata_dict["temperature"])
+        env_dict["lumen"] = float(metadata_dict["lumen"])
+        env_dict["decibel"] = float(metadata_dict["decibel"])
+        env_dict["floor_material"] = metadata_dict["floor"]
+        env_dict["gate_material"] = metadata_dict["door"]
+        env_dict["wall_material"] = metadata_dict["wall"]
+
+        env_dict["running_time"] = metadata_dict["running_time"]
+        if interaction_start_time and interaction_end_time:
+            env_dict["interaction_start_time"] = interaction_start_time
+            env_dict["interaction_end_time"] = interaction_end_time
+
+        return env_dict
+
+    def _create_task_header(self, data_labels: DataLabels, metadata_dict: dict) -> dict:
+        """
+        create the parts of the converted json that are the same for every frame of a task.
+        The returned dicts are shared by all frames and must not be modified.
+        Call it after _parse_social_interactions so that the interaction times are known.
+        """
+        task_header = dict()
+
+        default_license = dict()
+        # TODO: hard-coding it for now
+        default_license["name"] = "blackolive"
+        default_license["id"] = 0
+        default_license["url"] = "https://bo.testworks.ai/"
+        task_header["license"] = default_license
+
+        task_header["description"] = utils.get_dict_value(data_labels.meta_data, "task/project")
+        task_header["date_created"] = metadata_dict["date"]
+
+        task_header["env"] = None
+        task_header["scenario"] = None
+        if metadata_dict:
+            task_header["env"] = self._create_env_dict(metadata_dict,
+                                                       self.interaction_start_time, self.interaction_end_time)
+
+            scenario_dict = dict()
+            scenario_dict["id"] = metadata_dict["scenario_id"]
+            scenario_dict["start_time"] = metadata_dict["scenario_start_time"]
+            scenario_dict["end_time"] = metadata_dict["scenario_end_time"]
+            scenario_dict["distance_traveled"] = float(metadata_dict["distance_traveled"])
+            scenario_dict["len"] = len(data_labels.images)
+            task_header["scenario"] = scenario_dict
+
+        task_header["categories"] = None
+        if data_labels.meta_data:
+            task_header["categories"] = self._parse_class_names(data_labels.meta_data)
+
+        return task_header
+
+    @staticmethod
+    def _create_info_dict(task_header: dict, imu_dict: dict):
         info_dict = dict()
-        info_dict["description"] = description
-        info_dict["date_created"] = metadata_dict["date"]
+        info_dict["description"] = task_header["description"]
+        info_dict["date_created"] = task_header["date_created"]
 
-        if metadata_dict:
-            env_dict = dict()
-            env_dict["site"] = metadata_dict["site"]
-            env_dict["location"] = metadata_dict["location"]
-            env_dict["date"] = metadata_dict["date"]
-            env_dict["weather"] = metadata_dict["weather"]
-            env_dict["temperature"] = float(metadata_dict["temperature"])
-            env_dict["lumen"] = float(metadata_dict["lumen"])
-            env_dict["decibel"] = float(metadata_dict["decibel"])
-            env_dict["floor_material"] = metadata_dict["floor"]
-            env_dict["gate_material"] = metadata_dict["door"]
-            env_dict["wall_material"] = metadata_dict["wall"]
-
-            env_dict["running_time"] = metadata_dict["running_time"]
-            if self.interaction_start_time and self.interaction_end_time:
-                env_dict["interaction_start_time"] = self.interaction_start_time
-                env_dict["interaction_end_time"] = self.interaction_end_time
-
-            info_dict["env"] = env_dict
+        if task_header["env"]:
+            info_dict["env"] = task_header["env"]
 
         if imu_dict:
             info_dict["imu"] = imu_dict
@@ -151,115 +200,205 @@ class Project85Writer(BaseWriter):
             self.interaction_end_time = utils.seconds_to_hhmmss(end_time)
             # logger.info(f"### {self.interaction_start_time} {self.interaction_end_time}")
 
+    @staticmethod
+    def _create_imu_columns(imu_dict: dict):
+        """
+        convert the IMU columns into a single float array in one vectorized step
+        :param imu_dict: IMU data with key=column name value={row index: value}
+        :return: a list of column names except "Sequence" and a (rows, columns) float64 array
+        """
+        imu_keys = [key for key in imu_dict.keys() if key != "Sequence"]
+        row_count = len(imu_dict["Sequence"])
+        if not imu_keys:
+            return imu_keys, np.empty((row_count, 0), dtype=np.float64)
+
+        imu_values = np.array([list(imu_dict[key].values()) for key in imu_keys], dtype=np.float64).T
+        return imu_keys, imu_values
+
+    @staticmethod
+    def _index_cuboid_files(path_3d: str) -> dict:
+        """
+        index the cuboid label files of a 3D folder by frame number
+        :param path_3d: 3D folder with cuboid files named by frame number, e.g., 000001.json
+        :return: a dictionary with key=frame number value=cuboid label filename
+        """
+        cuboid_index = dict()
+        for cuboid_filename in sorted(glob.glob(os.path.join(path_3d, "*.json"))):
+            stem = Path(cuboid_filename).stem
+            if not stem.isdigit():
+                logger.warning(f"\tSkipping cuboid file without a frame number {cuboid_filename}")
+                continue
+
+            frame_number = int(stem)
+            if frame_number in cuboid_index:
+                logger.warning(f"\tDuplicate cuboid frame {frame_number}: {cuboid_filename} "
+                               f"ignored in favor of {cuboid_index[frame_number]}")
+                continue
+            cuboid_index[frame_number] = cuboid_filename
+
+        return cuboid_index
+
+    @staticmethod
+    def _read_raw_json(filename: str, default_json="{}") -> str:
+        """
+        read a JSON file as text without parsing it
+        """
+        with open(filename, 'rb') as file:
+            raw_json = file.read().decode('utf-8-sig').strip()
+        return raw_json if raw_json else default_json
+
+    @staticmethod
+    def validate_cuboid_files(path_3d: str) -> list:
+        """
+        parse every cuboid file of a 3D folder to check it is valid JSON.
+        This is a separate stage for the raw cuboid mode of write_85 which does not parse them.
+        :return: a list of invalid cuboid filenames
+        """
+        invalid_filenames = []
+        for cuboid_filename in Project85Writer._index_cuboid_files(path_3d).values():
+            try:
+                serializer.loads(Project85Writer._read_raw_json(cuboid_filename))
+            except ValueError as e:
+                logger.error(f"\tInvalid cuboid file {cuboid_filename}: {e}")
+                invalid_filenames.append(cuboid_filename)
+        return invalid_filenames
+
+    @staticmethod
+    def _write_json(converted_json: dict, sink, arcname: str, compact=False, raw_cuboid_filename=None):
+        json_data = serializer.dumps(converted_json, compact=compact)
+        if raw_cuboid_filename:
+            # splice the cuboid file as the last member instead of parsing and dumping it again
+            raw_cuboids = Project85Writer._read_raw_json(raw_cuboid_filename)
+            if compact:
+                json_data = json_data[:-1] + ',"pcd_annotations":' + raw_cuboids + '}'
+            else:
+                json_data = json_data[:-2] + ',\n  "pcd_annotations": ' + raw_cuboids + '\n}'
+        sink.write(arcname, json_data)
+
     def write_85(self, data_labels: DataLabels, path_3d: str,
-                 current_metadata_dict: dict, imu_dict: dict, path_out: str) -> None:
+                 current_metadata_dict: dict, imu_dict: dict, path_out: str, writer_threads: int = 0,
+                 compact=False, raw_cuboids=False, sink=None) -> None:
+        """
+        :param path_out: output folder. Only used when sink is not given
+        :param writer_threads: if > 0, serialize and write the frames in a bounded pool of threads
+            while the next frames are being built. The output is the same as writing sequentially.
+        :param compact: write JSON without indentation for machine consumers
+        :param raw_cuboids: copy the cuboid files into pcd_annotations as they are without parsing them.
+            The cuboid formatting is kept and the files are not validated (see validate_cuboid_files).
+        :param sink: an output sink of src.common.output_sink, e.g., to write into an archive.
+            The files are written as <task name>/<image stem>.json
+        """
         def _create_converted_json():
             """
             create the template for the converted json
             """
             converted_json = dict()
+            converted_json["license"] = task_header["license"]
+            # the IMU record of a frame is only built when the frame is written
+            imu_record = dict(zip(imu_keys, imu_values[idx].tolist()))
+            converted_json["info"] = self._create_info_dict(task_header, imu_record)
 
-            default_license = dict()
-            # TODO: hard-coding it for now
-            default_license["name"] = "blackolive"
-            default_license["id"] = 0
-            default_license["url"] = "https://bo.testworks.ai/"
+            if task_header["categories"] is not None:
+                converted_json["categories"] = task_header["categories"]
 
-            converted_json["license"] = default_license
+            return converted_json
 
-            info_dict = self._create_info_dict(utils.get_dict_value(data_labels.meta_data, "task/project"),
-                                               current_metadata_dict, imu_list[idx])
-            converted_json["info"] = info_dict
+        imu_keys, imu_values = self._create_imu_columns(imu_dict)
 
-            if data_labels.meta_data:
-                converted_json["categories"] = self._parse_class_names(data_labels.meta_data)
+        cuboid_index = self._index_cuboid_files(path_3d)
 
-            return converted_json
+        self._parse_social_interactions(data_labels)
+        task_header = self._create_task_header(data_labels, current_metadata_dict)
+        task_name = data_labels.meta_data["task"]["name"]
 
-        imu_list = []
-        keys = imu_dict.keys()
-        for idx in range(len(imu_dict["Sequence"])):
-            temp_dict = dict()
-            for key in keys:
-                if key != "Sequence":
-                    temp_dict[key] = float(imu_dict[key][idx])
-            imu_list.append(temp_dict)
+        if sink is None:
+            sink = FolderSink(path_out)
 
-        cuboid_filenames = utils.glob_files(path_3d, file_type="*.json")
-        cuboid_filenames.sort()
+        executor = None
+        pending_writes = deque()
+        if writer_threads > 0:
+            executor = ThreadPoolExecutor(max_workers=writer_threads)
 
-        self._parse_social_interactions(data_labels)
+        # cancel the queued writes if a frame fails so that nothing is written after write_85 raised
+        try:
+            for idx, image in enumerate(data_labels.images):
+                converted_json = _create_converted_json()
 
-        for idx, image in enumerate(data_labels.images):
-            converted_json = _create_converted_json()
-
-            task_name = data_labels.meta_data["task"]["name"]
-            image_filename = image.name
-            if image_filename.find(task_name) == -1:
-                image_filename = task_name + image_filename
-
-            # 1. images
-            image_id = int(image.image_id)
-            converted_image = dict()
-            converted_image["id"] = image_id
-            converted_image["width"] = image.width
-            converted_image["height"] = image.height
-            converted_image["file_name"] = image_filename
-            if self.out_of_focus.get(image_id):
-                converted_image["out_of_focus"] = self.out_of_focus[image_id]
-
-            # 1-1 Add scenario info if metadata are available
-            if current_metadata_dict:
-                scenario_dict = dict()
-                scenario_dict["id"] = current_metadata_dict["scenario_id"]
-                scenario_dict["start_time"] = current_metadata_dict["scenario_start_time"]
-                scenario_dict["end_time"] = current_metadata_dict["scenario_end_time"]
-                scenario_dict["distance_traveled"] = float(current_metadata_dict["distance_traveled"])
-                scenario_dict["len"] = len(data_labels.images)
-                scenario_dict["index"] = idx
-
-                converted_image["scenario"] = scenario_dict
-
-            # 2. Add annotations
-            converted_annotations = []
-
-            # logger.info(f"\tprocessing {image_filename}")
-            if image.objects:
-                for anno_object in image.objects:
-                    annotation = self._convert_annotation_dict(anno_object, int(image.image_id))
-                    converted_annotations.append(annotation)
-
-            converted_json["image"] = converted_image
-            converted_json["annotations"] = converted_annotations
-
-            # 3. pcd_images
-            # logger.info(f"## idx is {idx}/{len(cuboid_filenames)}")
-            image_filename_stem = Path(image_filename).stem
-            filename_tokens = image_filename_stem.split('_')
-            pcd_filename = Path(image_filename).stem + ".pcd"
-
-            pcd_image_dict = dict()
-            pcd_image_dict["id"] = int(image.image_id)
-            pcd_image_dict["file_name"] = pcd_filename
-            pcd_image_dict["license"] = 0
-
-            converted_json["pcd_image"] = pcd_image_dict
-
-            # 4. pcd_annotations
-            # TODO: have to remove extra "00" from cuboid filenames
-            cuboid_anno_filename = os.path.join(path_3d, "00" + filename_tokens[-1] + ".json")
-            converted_json["pcd_annotations"] = []
-            if cuboid_anno_filename in cuboid_filenames:
-                cuboid_labels = utils.from_file(cuboid_anno_filename)
-                converted_json["pcd_annotations"] = cuboid_labels
-
-            # 5. write out the converted json to a file
-            json_data = json.dumps(converted_json, default=utils.default, ensure_ascii=False, indent=2)
-
-            output_folder = os.path.join(path_out, task_name)
-            if not os.path.exists(output_folder):
-                os.mkdir(output_folder)
-
-            output_filename = os.path.join(output_folder, image_filename_stem + ".json")
-            # logger.info(f"{output_filename}")
-            utils.to_file(json_data, output_filename)
+                image_filename = image.name
+                if image_filename.find(task_name) == -1:
+                    image_filename = task_name + image_filename
+
+                # 1. images
+                image_id = int(image.image_id)
+                converted_image = dict()
+                converted_image["id"] = image_id
+                converted_image["width"] = image.width
+                converted_image["height"] = image.height
+                converted_image["file_name"] = image_filename
+                if self.out_of_focus.get(image_id):
+                    converted_image["out_of_focus"] = self.out_of_focus[image_id]
+
+                # 1-1 Add scenario info if metadata are available
+                if task_header["scenario"]:
+                    scenario_dict = dict(task_header["scenario"])
+                    scenario_dict["index"] = idx
+
+                    converted_image["scenario"] = scenario_dict
+
+                # 2. Add annotations
+                converted_annotations = []
+
+                # logger.info(f"\tprocessing {image_filename}")
+                if image.objects:
+                    for anno_object in image.objects:
+                        annotation = self._convert_annotation_dict(anno_object, int(image.image_id))
+                        converted_annotations.append(annotation)
+
+                converted_json["image"] = converted_image
+                converted_json["annotations"] = converted_annotations
+
+                # 3. pcd_images
+                # logger.info(f"## idx is {idx}/{len(cuboid_index)}")
+                image_filename_stem = Path(image_filename).stem
+                filename_tokens = image_filename_stem.split('_')
+                pcd_filename = Path(image_filename).stem + ".pcd"
+
+                pcd_image_dict = dict()
+                pcd_image_dict["id"] = int(image.image_id)
+                pcd_image_dict["file_name"] = pcd_filename
+                pcd_image_dict["license"] = 0
+
+                converted_json["pcd_image"] = pcd_image_dict
+
+                # 4. pcd_annotations
+                # cuboid filenames are matched by frame number so that their zero padding does not matter
+                cuboid_anno_filename = None
+                if filename_tokens[-1].isdigit():
+                    cuboid_anno_filename = cuboid_index.get(int(filename_tokens[-1]))
+                raw_cuboid_filename = None
+                if cuboid_anno_filename and raw_cuboids:
+                    # read and spliced in when the frame is written
+                    raw_cuboid_filename = cuboid_anno_filename
+                else:
+                    converted_json["pcd_annotations"] = []
+                    if cuboid_anno_filename:
+                        cuboid_labels = utils.from_file(cuboid_anno_filename)
+                        converted_json["pcd_annotations"] = cuboid_labels
+
+                # 5. write out the converted json to a file
+                arcname = task_name + "/" + image_filename_stem + ".json"
+                # logger.info(f"{arcname}")
+                if executor:
+                    # keep at most 2 frames per thread in flight so memory stays bounded
+                    if len(pending_writes) >= 2 * writer_threads:
+                        pending_writes.popleft().result()
+                    pending_writes.append(executor.submit(self._write_json, converted_json, sink, arcname,
+                                                          compact, raw_cuboid_filename))
+                else:
+                    self._write_json(converted_json, sink, arcname, compact, raw_cuboid_filename)
+
+            while pending_writes:
+                pending_writes.popleft().result()
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
@@ -0,0 +1,364 @@
+import gc
+
+import attr
+import numpy as np
+
+from src.common.logger import get_logger
+from src.models.data_labels import DataLabels
+
+logger = get_logger(__name__)
+
+
+"""
+Columnar (structure of arrays) form of DataLabels.
+Objects are stored in flat NumPy arrays instead of one DataLabels.Object per annotation:
+the objects of image i are object_offsets[i]:object_offsets[i+1] and the coordinates of object j
+are coordinates[coordinate_offsets[j]:coordinate_offsets[j+1]] with point_dims[j] values per point.
+Labels, types and attribute values are dictionary encoded as int32 codes into shared value lists.
+"""
+
+# attribute code of objects that do not have the attribute
+MISSING = -1
+
+
+class _Vocabulary:
+    """
+    assign an int code to every distinct value in the order they are first seen
+    """
+    def __init__(self):
+        self.values = []
+        self.codes = dict()
+
+    def encode(self, value) -> int:
+        # the type is part of the key so that e.g. 0, 0.0 and False are not merged
+        key = (value.__class__, value)
+        code = self.codes.get(key)
+        if code is None:
+            code = len(self.values)
+            self.codes[key] = code
+            self.values.append(value)
+        return code
+
+
+@attr.s(slots=True, frozen=False)
+class ColumnarLabels:
+    twconverted = attr.ib(default=None)
+    mode = attr.ib(default="annotation")
+    template_version = attr.ib(default="0.1")
+    meta_data = attr.ib(default=None)
+
+    # per image
+    image_ids = attr.ib(factory=list)
+    image_names = attr.ib(factory=list)
+    widths = attr.ib(factory=lambda: np.empty(0, dtype=np.int32))
+    heights = attr.ib(factory=lambda: np.empty(0, dtype=np.int32))
+    # (images + 1) offsets into the object columns
+    object_offsets = attr.ib(factory=lambda: np.zeros(1, dtype=np.int64))
+
+    # per object
+    labels = attr.ib(factory=list)
+    label_codes = attr.ib(factory=lambda: np.empty(0, dtype=np.int32))
+    types = attr.ib(factory=list)
+    type_codes = attr.ib(factory=lambda: np.empty(0, dtype=np.int32))
+    # values per point: 4 for a box [xtl, ytl, xbr, ybr], 2 for [x, y], 3 for [x, y, r], 0 without points
+    point_dims = attr.ib(factory=lambda: np.empty(0, dtype=np.int8))
+    # (objects + 1) offsets into coordinates
+    coordinate_offsets = attr.ib(factory=lambda: np.zeros(1, dtype=np.int64))
+    coordinates = attr.ib(factory=lambda: np.empty(0, dtype=np.float64))
+    # int32 codes into attribute_layouts, the attribute names of an object in their order.
+    # MISSING if the attributes are None or in raw_attributes
+    attribute_layout_codes = attr.ib(factory=lambda: np.empty(0, dtype=np.int32))
+    attribute_layouts = attr.ib(factory=list)
+    # key: attribute name, value: int32 codes into attribute_values[name], MISSING if not set
+    attribute_codes = attr.ib(factory=dict)
+    attribute_values = attr.ib(factory=dict)
+    # sparse columns. key: object index
+    verification_results = attr.ib(factory=dict)
+    # attributes that are not a dict or have unhashable values are kept as they are
+    raw_attributes = attr.ib(factory=dict)
+    # points that are None, not lists of float points or whose values per point differ are kept as they are
+    raw_points = attr.ib(factory=dict)
+
+    @property
+    def image_count(self) -> int:
+        return len(self.image_ids)
+
+    @property
+    def object_count(self) -> int:
+        return len(self.label_codes)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        :return: bytes used by the NumPy columns
+        """
+        arrays = [self.widths, self.heights, self.object_offsets, self.label_codes, self.type_codes,
+                  self.point_dims, self.coordinate_offsets, self.coordinates, self.attribute_layout_codes]
+        arrays.extend(self.attribute_codes.values())
+        return sum(array.nbytes for array in arrays)
+
+    @staticmethod
+    def from_data_labels(data_labels: DataLabels) -> 'ColumnarLabels':
+        widths, heights, object_offsets = [], [], [0]
+        label_vocabulary, type_vocabulary = _Vocabulary(), _Vocabulary()
+        label_codes, type_codes, point_dims, coordinate_offsets, coordinates = [], [], [], [0], []
+        layout_vocabulary, attribute_layout_codes = _Vocabulary(), []
+        # key: attribute name value: (vocabulary, {object index: code})
+        attribute_columns = dict()
+        verification_results, raw_attributes, raw_points = dict(), dict(), dict()
+
+        object_idx = 0
+        for image in data_labels.images:
+            widths.append(image.width)
+            heights.append(image.height)
+
+            for obj in image.objects:
+                label_codes.append(label_vocabulary.encode(obj.label))
+                type_codes.append(type_vocabulary.encode(obj.type))
+
+                points = obj.points
+                # only lists of [x, y...] points go into the columns. e.g., flat [x, y] points are kept as they are
+                is_point_list = isinstance(points, (list, tuple)) and \
+                    all(isinstance(point, (list, tuple)) for point in points)
+                point_dim = len(points[0]) if is_point_list and points else 0
+                if is_point_list and all(len(point) == point_dim and
+                                         all(type(value) is float for value in point) for point in points):
+                    for point in points:
+                        coordinates.extend(point)
+                else:
+                    raw_points[object_idx] = points
+                    point_dim = 0
+                point_dims.append(point_dim)
+                coordinate_offsets.append(len(coordinates))
+
+                layout_code = MISSING
+                if isinstance(obj.attributes, dict):
+                    try:
+                        # encode all values first so that an unhashable value leaves no partial codes
+                        encoded = []
+                        for name, value in obj.attributes.items():
+                            vocabulary = attribute_columns.setdefault(name, (_Vocabulary(), dict()))[0]
+                            encoded.append((name, vocabulary.encode(value)))
+                        for name, code in encoded:
+                            attribute_columns[name][1][object_idx] = code
+                        layout_code = layout_vocabulary.encode(tuple(obj.attributes))
+                    except TypeError:
+                        raw_attributes[object_idx] = obj.attributes
+                elif obj.attributes is not None:
+                    raw_attributes[object_idx] = obj.attributes
+                attribute_layout_codes.append(layout_code)
+
+                if obj.verification_result is not None:
+                    verification_results[object_idx] = obj.verification_result
+                object_idx += 1
+
+            object_offsets.append(object_idx)
+
+        attribute_codes, attribute_values = dict(), dict()
+        for name, (vocabulary, codes) in attribute_columns.items():
+            column = np.full(object_idx, MISSING, dtype=np.int32)
+            column[np.fromiter(codes.keys(), dtype=np.int64, count=len(codes))] = list(codes.values())
+            attribute_codes[name] = column
+            attribute_values[name] = vocabulary.values
+
+        return ColumnarLabels(
+            twconverted=data_labels.twconverted,
+            mode=data_labels.mode,
+            template_version=data_labels.template_version,
+            meta_data=data_labels.meta_data,
+            image_ids=[image.image_id for image in data_labels.images],
+            image_names=[image.name for image in data_labels.images],
+            widths=np.array(widths, dtype=np.int32),
+            heights=np.array(heights, dtype=np.int32),
+            object_offsets=np.array(object_offsets, dtype=np.int64),
+            labels=label_vocabulary.values,
+            label_codes=np.array(label_codes, dtype=np.int32),
+            types=type_vocabulary.values,
+            type_codes=np.array(type_codes, dtype=np.int32),
+            point_dims=np.array(point_dims, dtype=np.int8),
+            coordinate_offsets=np.array(coordinate_offsets, dtype=np.int64),
+            coordinates=np.array(coordinates, dtype=np.float64),
+            attribute_layout_codes=np.array(attribute_layout_codes, dtype=np.int32),
+            attribute_layouts=layout_vocabulary.values,
+            attribute_codes=attribute_codes,
+            attribute_values=attribute_values,
+            verification_results=verification_results,
+            raw_attributes=raw_attributes,
+            raw_points=raw_points
+        )
+
+    def get_points(self, object_idx: int) -> np.ndarray:
+        """
+        :return: a (points, values per point) view of the coordinates of an object. Empty for raw_points
+        """
+        start, end = self.coordinate_offsets[object_idx], self.coordinate_offsets[object_idx + 1]
+        point_dim = int(self.point_dims[object_idx])
+        if point_dim == 0:
+            return self.coordinates[start:end].reshape(0, 0)
+        return self.coordinates[start:end].reshape(-1, point_dim)
+
+    def get_object(self, object_idx: int) -> DataLabels.Object:
+        attributes = self.raw_attributes.get(object_idx)
+        layout_code = self.attribute_layout_codes[object_idx]
+        if layout_code != MISSING:
+            attributes = {name: self.attribute_values[name][self.attribute_codes[name][object_idx]]
+                          for name in self.attribute_layouts[layout_code]}
+
+        if object_idx in self.raw_points:
+            points = self.raw_points[object_idx]
+        else:
+            points = self.get_points(object_idx).tolist()
+
+        return DataLabels.Object(label=self.labels[self.label_codes[object_idx]],
+                                 type=self.types[self.type_codes[object_idx]],
+                                 points=points,
+                                 attributes=attributes,
+                                 verification_result=self.verification_results.get(object_idx))
+
+    def get_image(self, image_idx: int) -> DataLabels.Image:
+        start, end = self.object_offsets[image_idx], self.object_offsets[image_idx + 1]
+        return DataLabels.Image(image_id=self.image_ids[image_idx],
+                                name=self.image_names[image_idx],
+                                width=int(self.widths[image_idx]),
+                                height=int(self.heights[image_idx]),
+                                objects=[self.get_object(object_idx) for object_idx in range(start, end)])
+
+    def _get_point_lists(self) -> list:
+        """
+        :return: the points of every object as lists, converted once per point layout instead of per object
+        """
+        point_lists = [[] for _ in range(self.object_count)]
+        for point_dim in np.unique(self.point_dims[self.point_dims > 0]).tolist():
+            object_indices = np.flatnonzero(self.point_dims == point_dim)
+            starts = self.coordinate_offsets[object_indices]
+            sizes = self.coordinate_offsets[object_indices + 1] - starts
+            # gather the coordinates of all objects with this layout into one (points, point_dim) array
+            segment_starts = np.cumsum(sizes) - sizes
+            coordinate_indices = np.repeat(starts - segment_starts, sizes) + np.arange(sizes.sum())
+            rows = self.coordinates[coordinate_indices].reshape(-1, point_dim).tolist()
+
+            row_offsets = (segment_starts // point_dim).tolist() + [len(rows)]
+            for idx, object_idx in enumerate(object_indices.tolist()):
+                point_lists[object_idx] = rows[row_offsets[idx]:row_offsets[idx + 1]]
+
+        for object_idx, points in self.raw_points.items():
+            point_lists[object_idx] = points
+        return point_lists
+
+    def to_data_labels(self) -> DataLabels:
+        """
+        convert back to DataLabels. The columns are converted to lists once instead of per object
+        """
+        # the cyclic garbage collector would rescan the growing object graph many times while it is built
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._to_data_labels()
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _to_data_labels(self) -> DataLabels:
+        labels = [self.labels[code] for code in self.label_codes.tolist()]
+        types = [self.types[code] for code in self.type_codes.tolist()]
+        point_lists = self._get_point_lists()
+        attribute_layout_codes = self.attribute_layout_codes.tolist()
+        attribute_columns = {name: (self.attribute_values[name], codes.tolist())
+                             for name, codes in self.attribute_codes.items()}
+        # key: layout code, value: [(name, values, codes)...] of the attributes in order
+        attribute_layouts = [[(name,) + attribute_columns[name] for name in layout]
+                             for layout in self.attribute_layouts]
+
+        objects = []
+        for object_idx, layout_code in enumerate(attribute_layout_codes):
+            if layout_code != MISSING:
+                attributes = {name: values[codes[object_idx]] for name, values, codes in attribute_layouts[layout_code]}
+            else:
+                attributes = self.raw_attributes.get(object_idx)
+
+            objects.append(DataLabels.Object(label=labels[object_idx],
+                                             type=types[object_idx],
+                                             points=point_lists[object_idx],
+                                             attributes=attributes,
+                                             verification_result=self.verification_results.get(object_idx)))
+
+        object_offsets = self.object_offsets.tolist()
+        widths, heights = self.widths.tolist(), self.heights.tolist()
+        images = [DataLabels.Image(image_id=self.image_ids[image_idx],
+                                   name=self.image_names[image_idx],
+                                   width=widths[image_idx],
+                                   height=heights[image_idx],
+                                   objects=objects[object_offsets[image_idx]:object_offsets[image_idx + 1]])
+                  for image_idx in range(self.image_count)]
+
+        return DataLabels(
+            twconverted=self.twconverted,
+            mode=self.mode,
+            template_version=self.template_version,
+            images=images,
+            meta_data=self.meta_data
+        )
+
+    def get_object_image_indices(self) -> np.ndarray:
+        """
+        :return: the image index of every object
+        """
+        return np.repeat(np.arange(self.image_count), np.diff(self.object_offsets))
+
+    def get_label_counts(self) -> dict:
+        """
+        :return: a dictionary with key=label value=number of objects
+        """
+        counts = np.bincount(self.label_codes, minlength=len(self.labels))
+        return {label: int(count) for label, count in zip(self.labels, counts)}
+
+    def get_type_mask(self, object_type: str) -> np.ndarray:
+        """
+        :return: a boolean mask of the objects of the given type, e.g., 'box'
+        """
+        if object_type not in self.types:
+            return np.zeros(self.object_count, dtype=bool)
+        return self.type_codes == self.types.index(object_type)
+
+    def get_boxes(self) -> np.ndarray:
+        """
+        :return: a (boxes, 4) array of [xtl, ytl, xbr, ybr] of all box objects
+        """
+        box_indices = np.flatnonzero(self.get_type_mask('box') & (self.point_dims == 4))
+        return self.coordinates[self.coordinate_offsets[box_indices][:, None] + np.arange(4)]
+
+    def get_bounding_rectangles(self) -> np.ndarray:
+        """
+        get the rectangles of all objects from the coordinate columns without touching Python objects.
+        Same values as DataLabels.Object.get_bounding_rectangles
+        :return: a (objects, 4) float array of xtl,ytl, xbr,ybr. NaN for objects without points
+        """
+        rectangles = np.full((self.object_count, 4), np.nan)
+
+        box_mask = self.get_type_mask('box') & (self.point_dims >= 4)
+        box_indices = np.flatnonzero(box_mask)
+        rectangles[box_indices] = self.coordinates[self.coordinate_offsets[box_indices][:, None] + np.arange(4)]
+
+        # ragged points are not in the coordinate columns
+        if self.raw_points:
+            raw_indices = list(self.raw_points.keys())
+            rectangles[raw_indices] = DataLabels.Object.get_bounding_rectangles(
+                [self.get_object(object_idx) for object_idx in raw_indices])
+
+        shape_indices = np.flatnonzero(~self.get_type_mask('box') & (self.point_dims >= 2))
+        if len(shape_indices) == 0:
+            return rectangles
+
+        point_dims = self.point_dims[shape_indices].astype(np.int64)
+        point_counts = np.diff(self.coordinate_offsets)[shape_indices] // point_dims
+        starts = np.concatenate(([0], np.cumsum(point_counts)[:-1]))
+        # coordinate index of the x of every point: object offset + point number * values per point
+        point_numbers = np.arange(point_counts.sum()) - np.repeat(starts, point_counts)
+        x_indices = np.repeat(self.coordinate_offsets[shape_indices], point_counts) + \
+            point_numbers * np.repeat(point_dims, point_counts)
+        xs, ys = np.trunc(self.coordinates[x_indices]), np.trunc(self.coordinates[x_indices + 1])
+
+        rectangles[shape_indices] = np.stack([np.minimum.reduceat(xs, starts), np.minimum.reduceat(ys, starts),
+                                              np.maximum.reduceat(xs, starts), np.maximum.reduceat(ys, starts)],
+                                             axis=1)
+        return rectangles
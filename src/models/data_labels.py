@@ -1,24 +1,38 @@
-import json
 import math
 import os
 
 import attr
+import numpy as np
 
+import src.common.serializer as serializer
 import src.common.utils as utils
 from src.common.logger import get_logger
 from src.converters.base_reader import CONVERT_ID, CONVERT_VERSION
 from src.models.adq_labels import AdqLabels
+from src.models.label_stats import LabelStats
 
 logger = get_logger(__name__)
 
+# snapshot kind of the files read by DataLabels.load
+DATA_LABELS_SNAPSHOT = "data_labels"
+
 
 @attr.s(slots=True, frozen=False)
 class DataLabels:
     twconverted = attr.ib(default=None, validator=attr.validators.instance_of(str))
     mode = attr.ib(default="annotation", validator=attr.validators.instance_of(str))
     template_version = attr.ib(default="0.1", validator=attr.validators.instance_of(str))
-    images = attr.ib(default=[], validator=attr.validators.instance_of(list))
+    images = attr.ib(factory=list, validator=attr.validators.instance_of(list))
     meta_data = attr.ib(default=None)
+    # lazily built by _get_image_index. key: name or image_id, value: index in images
+    _image_index_by_name = attr.ib(default=None, init=False, repr=False, eq=False)
+    _image_index_by_id = attr.ib(default=None, init=False, repr=False, eq=False)
+    # the images list and its length when it was indexed. The index is rebuilt if images is reassigned
+    _indexed_images = attr.ib(default=None, init=False, repr=False, eq=False)
+    _indexed_image_count = attr.ib(default=0, init=False, repr=False, eq=False)
+    # lazily built by get_label_stats for the images list it was built from
+    _label_stats = attr.ib(default=None, init=False, repr=False, eq=False)
+    _label_stats_images = attr.ib(default=None, init=False, repr=False, eq=False)
 
     def to_json(self):
         return {
@@ -29,16 +43,112 @@ class DataLabels:
             "meta_data": self.meta_data
         }
 
-    def save(self, filename: str):
-        json_data = json.dumps(self.to_json(), default=utils.default, ensure_ascii=False, indent=2)
+    def save(self, filename: str, compact=False):
+        json_data = serializer.dumps(self.to_json(), compact=compact)
         utils.to_file(json_data, filename)
 
-    def save_image(self, image_to_save: 'DataLabels.Image'):
+    def reindex_images(self):
+        """
+        rebuild the image index and the label statistics.
+        Call it after changing images or their objects without add_image or save_image.
+        """
+        self._build_image_index()
+        self._label_stats = None
+
+    def _build_image_index(self):
+        """
+        the first image wins for duplicate names or ids
+        """
+        self._image_index_by_name = dict()
+        self._image_index_by_id = dict()
         for idx, image in enumerate(self.images):
-            if image.name == image_to_save.name:
-                self.images[idx] = image_to_save
-                break
-        logger.error(f"Cannot find a matching image {image_to_save}")
+            self._image_index_by_name.setdefault(image.name, idx)
+            self._image_index_by_id.setdefault(image.image_id, idx)
+        self._indexed_images = self.images
+        self._indexed_image_count = len(self.images)
+
+    def _is_image_index_current(self) -> bool:
+        return self._image_index_by_name is not None and self._indexed_images is self.images and \
+            self._indexed_image_count == len(self.images)
+
+    def _get_image_index(self, key: str, by_name=True) -> int:
+        """
+        :return: the index of the image with the given name or image_id. -1 if not found
+        """
+        is_rebuilt = False
+        if not self._is_image_index_current():
+            self._build_image_index()
+            is_rebuilt = True
+
+        idx = (self._image_index_by_name if by_name else self._image_index_by_id).get(key)
+        if idx is not None:
+            image = self.images[idx]
+            if (image.name if by_name else image.image_id) == key:
+                return idx
+
+        if is_rebuilt:
+            return -1
+        # a miss or a stale hit since an image could have been replaced in place, e.g., images[i] = image
+        self._build_image_index()
+        return (self._image_index_by_name if by_name else self._image_index_by_id).get(key, -1)
+
+    def get_image_by_name(self, name: str) -> 'DataLabels.Image':
+        """
+        :return: the image with the given name or None
+        """
+        idx = self._get_image_index(name, by_name=True)
+        return self.images[idx] if idx != -1 else None
+
+    def get_image_by_id(self, image_id: str) -> 'DataLabels.Image':
+        """
+        :return: the image with the given image_id or None
+        """
+        idx = self._get_image_index(image_id, by_name=False)
+        return self.images[idx] if idx != -1 else None
+
+    def _is_label_stats_current(self) -> bool:
+        return self._label_stats is not None and self._label_stats_images is self.images and \
+            self._label_stats.image_count == len(self.images)
+
+    def get_label_stats(self) -> LabelStats:
+        """
+        label statistics built in one pass and kept up to date by add_image and save_image.
+        They are rebuilt if images was reassigned or an image was replaced, e.g., images[i] = image.
+        Objects edited in place are not seen until reindex_images or save_image of their image is called.
+        get_class_labels and get_verification_result_sum always count the current objects.
+        """
+        if not self._is_label_stats_current() or not self._label_stats.is_current(self.images):
+            self._label_stats = LabelStats.from_images(self.images)
+            self._label_stats_images = self.images
+        return self._label_stats
+
+    def add_image(self, image: 'DataLabels.Image'):
+        if self._is_label_stats_current():
+            self._label_stats.add_image(image)
+        is_index_current = self._is_image_index_current()
+        self.images.append(image)
+        if is_index_current:
+            self._image_index_by_name.setdefault(image.name, len(self.images) - 1)
+            self._image_index_by_id.setdefault(image.image_id, len(self.images) - 1)
+            self._indexed_image_count = len(self.images)
+
+    def save_image(self, image_to_save: 'DataLabels.Image') -> bool:
+        """
+        replace the image with the same name
+        :return: True if a matching image was found
+        """
+        idx = self._get_image_index(image_to_save.name, by_name=True)
+        if idx == -1:
+            logger.error(f"Cannot find a matching image {image_to_save}")
+            return False
+
+        old_image = self.images[idx]
+        if self._is_label_stats_current():
+            self._label_stats.replace_image(idx, image_to_save)
+        self.images[idx] = image_to_save
+        if old_image.image_id != image_to_save.image_id:
+            self._build_image_index()
+        return True
 
     def get_class_labels(self):
         """
@@ -101,18 +211,27 @@ class DataLabels:
     def load(filename: str) -> 'DataLabels':
         """
         :param filename: label filename
-        :return: DartLabels object
+        :return: DartLabels object. Reused from its binary snapshot if the file has not changed
         """
+        # imported here since the snapshot module builds on DataLabels
+        from src.models import label_snapshot
+
+        data_labels = label_snapshot.load_snapshot(filename, DATA_LABELS_SNAPSHOT)
+        if data_labels:
+            return data_labels
+
         json_labels = utils.from_file(filename)
         # check if it is already in DartLabels format
         # TODO: find a better way of checking the format
         if json_labels:
             if json_labels.get('images') and type(json_labels.get('images')[0]['height']) == int:
-                return DataLabels.from_json(json_labels)
+                data_labels = DataLabels.from_json(json_labels)
             else:
                 adq_labels = AdqLabels.from_json(json_labels)
                 # convert to dart label format for easier processing
-                return DataLabels.from_adq_labels(adq_labels)
+                data_labels = DataLabels.from_adq_labels(adq_labels)
+            label_snapshot.save_snapshot(data_labels, filename, DATA_LABELS_SNAPSHOT)
+            return data_labels
         else:
             logger.error("label file {} does not exist!".format(filename))
 
@@ -163,6 +282,12 @@ class DataLabels:
                 class_labels.add(obj.label)
             return class_labels
 
+        def get_bounding_rectangles(self) -> np.ndarray:
+            """
+            :return: a (N, 4) float array of xtl,ytl, xbr,ybr of the objects in order
+            """
+            return DataLabels.Object.get_bounding_rectangles(self.objects)
+
         def get_class_label_stats(self):
             class_labels = dict()
             for obj in self.objects:
@@ -307,3 +432,36 @@ class DataLabels:
                         max_y = y
 
                 return [min_x, min_y, max_x, max_y]
+
+        @staticmethod
+        def get_bounding_rectangles(label_objects: list) -> np.ndarray:
+            """
+            get the rectangles of many objects at once. Same values as get_bounding_rectangle
+            :param label_objects: label objects whose points could be [[x,y,r]...] or [[x,y]...]
+            :return: a (N, 4) float array of xtl,ytl, xbr,ybr. NaN for objects without points
+            """
+            rectangles = np.full((len(label_objects), 4), np.nan)
+            if not label_objects:
+                return rectangles
+
+            boxes = [(idx, obj.points[0]) for idx, obj in enumerate(label_objects) if obj.type == 'box' and obj.points]
+            if boxes:
+                rectangles[[idx for idx, _ in boxes]] = [box[:4] for _, box in boxes]
+
+            shapes = [(idx, obj.points) for idx, obj in enumerate(label_objects) if obj.type != 'box' and obj.points]
+            if shapes:
+                # stack the x and y of all points and reduce them per object
+                point_counts = np.array([len(points) for _, points in shapes])
+                point_count = int(point_counts.sum())
+                xs = np.fromiter((pt[0] for _, points in shapes for pt in points), dtype=np.float64, count=point_count)
+                ys = np.fromiter((pt[1] for _, points in shapes for pt in points), dtype=np.float64, count=point_count)
+                # int() of get_bounding_rectangle truncates toward zero
+                xs, ys = np.trunc(xs), np.trunc(ys)
+
+                starts = np.concatenate(([0], np.cumsum(point_counts)[:-1]))
+                rectangles[[idx for idx, _ in shapes]] = np.stack([np.minimum.reduceat(xs, starts),
+                                                                   np.minimum.reduceat(ys, starts),
+                                                                   np.maximum.reduceat(xs, starts),
+                                                                   np.maximum.reduceat(ys, starts)], axis=1)
+
+            return rectangles
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+import src.common.serializer as serializer
+from src.common.logger import get_logger
+from src.models.columnar_labels import ColumnarLabels
+from src.models.data_labels import DataLabels
+
+logger = get_logger(__name__)
+
+
+"""
+Binary snapshots of parsed DataLabels so that an unchanged label file is not parsed again.
+A snapshot is a NumPy .npz of the ColumnarLabels arrays plus a JSON header with the string tables.
+It is keyed by the absolute path, size and modification time of the source label file.
+"""
+
+SNAPSHOT_VERSION = 1
+
+# folder of the snapshots. Set it to an empty string to disable the cache
+SNAPSHOT_DIR_ENV = "LABEL_CONVERTER_SNAPSHOT_DIR"
+DEFAULT_SNAPSHOT_DIR = os.path.join(str(Path.home()), ".cache", "label_converter", "snapshots")
+
+# smaller label files are parsed faster than a snapshot is created
+SNAPSHOT_MIN_SIZE = 1024 * 1024
+
+ARRAY_FIELDS = ["widths", "heights", "object_offsets", "label_codes", "type_codes", "point_dims",
+                "coordinate_offsets", "coordinates", "attribute_layout_codes"]
+LIST_FIELDS = ["twconverted", "mode", "template_version", "meta_data", "image_ids", "image_names",
+               "labels", "types", "attribute_layouts"]
+# dictionaries keyed by object index. Saved as [[index, value]...] since JSON keys are strings
+SPARSE_FIELDS = ["verification_results", "raw_attributes", "raw_points"]
+
+
+def get_snapshot_dir() -> str:
+    snapshot_dir = os.environ.get(SNAPSHOT_DIR_ENV)
+    return DEFAULT_SNAPSHOT_DIR if snapshot_dir is None else snapshot_dir
+
+
+def _get_source_key(source_filename: str) -> list:
+    stat = os.stat(source_filename)
+    return [os.path.abspath(source_filename), stat.st_size, stat.st_mtime_ns]
+
+
+def get_snapshot_filename(source_filename: str, kind: str):
+    """
+    :param kind: the reader of the source file, e.g., "data_labels" or "cvat"
+    :return: the snapshot filename or None if the cache is disabled
+    """
+    snapshot_dir = get_snapshot_dir()
+    if not snapshot_dir:
+        return None
+
+    digest = hashlib.sha1(f"{kind}:{os.path.abspath(source_filename)}".encode("utf-8")).hexdigest()
+    return os.path.join(snapshot_dir, digest + ".npz")
+
+
+def save_snapshot(data_labels: DataLabels, source_filename: str, kind: str) -> bool:
+    """
+    :return: True if the snapshot was written
+    """
+    snapshot_filename = get_snapshot_filename(source_filename, kind)
+    if not snapshot_filename or os.path.getsize(source_filename) < SNAPSHOT_MIN_SIZE:
+        return False
+
+    # the snapshot is only a cache so a label file it can't represent is still loaded
+    try:
+        columnar_labels = ColumnarLabels.from_data_labels(data_labels)
+        header = {"version": SNAPSHOT_VERSION, "kind": kind, "source": _get_source_key(source_filename),
+                  "attribute_names": list(columnar_labels.attribute_codes.keys()),
+                  "attribute_values": list(columnar_labels.attribute_values.values())}
+        for field in LIST_FIELDS:
+            header[field] = getattr(columnar_labels, field)
+        for field in SPARSE_FIELDS:
+            header[field] = [[object_idx, value] for object_idx, value in getattr(columnar_labels, field).items()]
+
+        arrays = {field: getattr(columnar_labels, field) for field in ARRAY_FIELDS}
+        for idx, codes in enumerate(columnar_labels.attribute_codes.values()):
+            arrays[f"attribute_codes_{idx}"] = codes
+        arrays["header"] = np.frombuffer(serializer.dumps(header, compact=True).encode("utf-8"), dtype=np.uint8)
+
+        snapshot_dir = os.path.dirname(snapshot_filename)
+        os.makedirs(snapshot_dir, exist_ok=True)
+        # write to a temporary file first so that readers never see a partial snapshot
+        with tempfile.NamedTemporaryFile(dir=snapshot_dir, suffix=".tmp", delete=False) as snapshot_file:
+            np.savez(snapshot_file, **arrays)
+        os.replace(snapshot_file.name, snapshot_filename)
+    except Exception as e:
+        logger.warning(f"Cannot save the snapshot of {source_filename} to {snapshot_filename}: {e}")
+        return False
+
+    return True
+
+
+def load_columnar_snapshot(source_filename: str, kind: str):
+    """
+    :return: ColumnarLabels of a valid snapshot of source_filename or None
+    """
+    snapshot_filename = get_snapshot_filename(source_filename, kind)
+    if not snapshot_filename or not os.path.exists(snapshot_filename) or not os.path.exists(source_filename):
+        return None
+
+    try:
+        with np.load(snapshot_filename, allow_pickle=False) as snapshot:
+            header = serializer.loads(snapshot["header"].tobytes())
+            if header["version"] != SNAPSHOT_VERSION or header["kind"] != kind or \
+                    header["source"] != _get_source_key(source_filename):
+                return None
+
+            fields = {field: snapshot[field] for field in ARRAY_FIELDS}
+            fields["attribute_codes"] = {name: snapshot[f"attribute_codes_{idx}"]
+                                         for idx, name in enumerate(header["attribute_names"])}
+    except (OSError, KeyError, ValueError) as e:
+        logger.warning(f"Ignoring the invalid snapshot {snapshot_filename}: {e}")
+        return None
+
+    for field in LIST_FIELDS:
+        fields[field] = header[field]
+    # JSON arrays come back as lists
+    fields["attribute_layouts"] = [tuple(layout) for layout in header["attribute_layouts"]]
+    fields["attribute_values"] = dict(zip(header["attribute_names"], header["attribute_values"]))
+    for field in SPARSE_FIELDS:
+        fields[field] = {object_idx: value for object_idx, value in header[field]}
+
+    return ColumnarLabels(**fields)
+
+
+def load_snapshot(source_filename: str, kind: str):
+    """
+    :return: DataLabels of a valid snapshot of source_filename or None
+    """
+    columnar_labels = load_columnar_snapshot(source_filename, kind)
+    if columnar_labels is None:
+        return None
+
+    logger.info(f"Loaded {source_filename} from its snapshot")
+    return columnar_labels.to_data_labels()
@@ -0,0 +1,83 @@
+from collections import Counter
+
+import attr
+
+
+"""
+Class label statistics of DataLabels that are built in one pass and updated as images are added or replaced
+"""
+
+
+@attr.s(slots=True, frozen=False)
+class LabelStats:
+    # key: label, value: number of objects
+    label_counts = attr.ib(factory=Counter)
+    # label counts of every image in the order of DataLabels.images
+    image_label_counts = attr.ib(factory=list)
+    # number of objects with a verification result of every image in the order of DataLabels.images
+    image_verification_result_sums = attr.ib(factory=list)
+    # number of objects with a verification result
+    verification_result_sum = attr.ib(default=0)
+    # the counted images to tell if an image of DataLabels.images was replaced
+    images = attr.ib(factory=list, repr=False, eq=False)
+
+    @property
+    def image_count(self) -> int:
+        return len(self.image_label_counts)
+
+    def is_current(self, images: list) -> bool:
+        """
+        :return: True if images are the counted images. Objects edited in place are not detected
+        """
+        return len(images) == len(self.images) and all(image is counted for image, counted in zip(images, self.images))
+
+    @staticmethod
+    def _count_image(image):
+        """
+        :return: (label counts, number of objects with a verification result) of an image
+        """
+        image_label_counts = Counter(obj.label for obj in image.objects)
+        verification_result_sum = sum(1 for obj in image.objects if obj.verification_result)
+        return image_label_counts, verification_result_sum
+
+    @staticmethod
+    def from_images(images: list) -> 'LabelStats':
+        label_stats = LabelStats()
+        for image in images:
+            label_stats.add_image(image)
+        return label_stats
+
+    def add_image(self, image):
+        image_label_counts, verification_result_sum = self._count_image(image)
+        self.image_label_counts.append(image_label_counts)
+        self.image_verification_result_sums.append(verification_result_sum)
+        self.images.append(image)
+        self.label_counts.update(image_label_counts)
+        self.verification_result_sum += verification_result_sum
+
+    def replace_image(self, idx: int, new_image):
+        """
+        subtract the counts of the image at idx as they were counted, since it could have been edited in place
+        :param idx: index of the replaced image in DataLabels.images
+        """
+        self.label_counts -= self.image_label_counts[idx]
+        self.verification_result_sum -= self.image_verification_result_sums[idx]
+
+        image_label_counts, verification_result_sum = self._count_image(new_image)
+        self.image_label_counts[idx] = image_label_counts
+        self.image_verification_result_sums[idx] = verification_result_sum
+        self.images[idx] = new_image
+        self.label_counts.update(image_label_counts)
+        self.verification_result_sum += verification_result_sum
+
+    def get_class_labels(self) -> set:
+        return set(self.label_counts.keys())
+
+    def get_image_class_labels(self, idx: int) -> set:
+        return set(self.image_label_counts[idx].keys())
+
+    def get_image_class_label_stats(self, idx: int) -> dict:
+        """
+        :return: same as DataLabels.Image.get_class_label_stats without walking the objects
+        """
+        return dict(self.image_label_counts[idx])
@@ -1,10 +1,13 @@
 import argparse
-import json
+import functools
 import os.path
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 
 import json2html
 
+import src.common.serializer as serializer
 import src.common.utils as utils
 from src.common.logger import get_logger
 
@@ -15,6 +18,8 @@ logger = get_logger(__name__)
 verify project 85 labels
 """
 OUT_OF_FOCUS = "Out of focus"
+# number of error records per HTML page of a streaming report
+REPORT_PAGE_SIZE = 1000
 
 
 class LabelCountError(Enum):
@@ -79,7 +84,224 @@ PLACE_CLASSES_STATIC = {
 }
 
 
-def verify_project85_labels(path_in: str, path_out: str):
+def build_place_valid_classes(place_classes: dict) -> dict:
+    """
+    :param place_classes: a dictionary with key=place code value=list of static classes
+    :return: a dictionary with key=place code value=frozenset of valid class names including person
+    """
+    return {place: frozenset(classes) | frozenset(CLASS_PERSON) for place, classes in place_classes.items()}
+
+
+def load_place_valid_classes(place_classes_file: str = None) -> dict:
+    """
+    :param place_classes_file: optional JSON file with key=place code value=list of static classes
+        which adds new places to or overrides places of PLACE_CLASSES_STATIC
+    :return: the place validation table
+    """
+    place_classes = dict(PLACE_CLASSES_STATIC)
+    if place_classes_file:
+        place_classes.update(utils.from_file(place_classes_file))
+    return build_place_valid_classes(place_classes)
+
+
+PLACE_VALID_CLASSES = build_place_valid_classes(PLACE_CLASSES_STATIC)
+
+# the categories block is the same for all frames of a task so the last id -> name map is reused
+_category_names_cache = {"categories": None, "names": None}
+
+
+def get_category_names(categories: list) -> dict:
+    """
+    :return: a dictionary with key=category id value=category name
+    """
+    if categories != _category_names_cache["categories"]:
+        _category_names_cache["categories"] = categories
+        _category_names_cache["names"] = {category.get("id"): category.get("name") for category in categories}
+    return _category_names_cache["names"]
+
+
+def verify_label_file(label_file: str, place_valid_classes: dict = PLACE_VALID_CLASSES):
+    """
+    :param label_file: converted Project85 label file
+    :param place_valid_classes: place validation table from load_place_valid_classes
+    :return: (label count error, label ID error, out of place error); each is None if there is no error
+    """
+    logger.info(f"Processing {label_file}")
+    label_data_json = utils.from_file(label_file)
+
+    image = label_data_json.get("image")
+    image_basename = os.path.basename(image.get("file_name"))
+    if not image_basename:
+        logger.error(f"empty image file name {image}")
+        return None, None, None
+
+    labels_2d = label_data_json.get("annotations")
+    labels_3d = label_data_json.get("pcd_annotations")
+
+    # 1. label count errors
+    count_labels_2d = len(labels_2d)
+    count_labels_3d = len(labels_3d)
+
+    label_count_error = None
+    if count_labels_2d != count_labels_3d or count_labels_2d == 0 or count_labels_3d == 0:
+        label_count_error = dict()
+        label_count_error[image_basename] = {"2d_label_count": count_labels_2d,
+                                             "3d_label_count": count_labels_3d}
+
+    # 2. label ID errors
+    anno_ids_2d = [str(anno.get("id")) for anno in labels_2d]
+    anno_ids_3d = [str(anno.get("obj_id")) for anno in labels_3d]
+    anno_ids_2d.sort()
+    anno_ids_3d.sort()
+
+    # 2D against 3D
+    # key: image_name
+    # value: {
+    #    anno_ids_2d: [],
+    #    anno_ids_3d: [],
+    #    anno_id_errors: [],
+    #    missing_in_2d: [],
+    #    missing_in_3d: []
+    # }
+    label_id_error = None
+    anno_id_errors = []
+    if not all(anno_id_2d.isdigit() for anno_id_2d in anno_ids_2d):
+        anno_id_errors.append(LabelIDError.Invalid_ID_2D.name)
+    if not all(anno_id_3d.isdigit() for anno_id_3d in anno_ids_3d):
+        anno_id_errors.append(LabelIDError.Invalid_ID_3D.name)
+
+    # multiset differences so that duplicated IDs are caught as well
+    counts_2d = Counter(anno_ids_2d)
+    counts_3d = Counter(anno_ids_3d)
+    missing_in_2d = sorted((counts_3d - counts_2d).elements())
+    missing_in_3d = sorted((counts_2d - counts_3d).elements())
+    if missing_in_2d or missing_in_3d:
+        anno_id_errors.append(LabelIDError.ID_Mismatch.name)
+
+    if len(anno_id_errors) > 0:
+        label_id_error = dict()
+        label_id_error[image_basename] = {
+            "anno_ids_2d": anno_ids_2d,
+            "anno_ids_3d": anno_ids_3d,
+            "anno_id_errors": anno_id_errors,
+            "missing_in_2d": missing_in_2d,
+            "missing_in_3d": missing_in_3d
+        }
+
+    # logger.info(label_id_error)
+
+    # 3. out of place classes
+    category_names = get_category_names(label_data_json.get("categories"))
+    anno_names_2d = [category_names.get(anno.get("category_id")) for anno in labels_2d]
+    anno_names_3d = [anno.get("obj_type") for anno in labels_3d]
+
+    anno_names_2d.sort()
+    anno_names_3d.sort()
+
+    tokens = image_basename.split('_')
+    place = tokens[1]
+    # logger.info(place)
+
+    valid_classes = place_valid_classes.get(place)
+    if valid_classes is None:
+        logger.error(f"unknown place {place} in {image_basename}")
+        valid_classes = frozenset(CLASS_PERSON)
+
+    # skip OUT_OF_FOCUS
+    invalid_classes_2d = [anno_name_2d for anno_name_2d in anno_names_2d
+                          if anno_name_2d != OUT_OF_FOCUS and anno_name_2d not in valid_classes]
+    invalid_classes_3d = [anno_name_3d for anno_name_3d in anno_names_3d if anno_name_3d not in valid_classes]
+
+    out_of_place_error = None
+    if len(invalid_classes_2d) > 0 or len(invalid_classes_3d) > 0:
+        out_of_place_error = {image_basename: {
+            "anno_names_2d": anno_names_2d,
+            "anno_names_3d": anno_names_3d,
+            "invalid_classes_2d": invalid_classes_2d,
+            "invalid_classes_3d": invalid_classes_3d
+        }}
+
+    # logger.info(out_of_place_error)
+
+    return label_count_error, label_id_error, out_of_place_error
+
+
+def _iter_verification_results(label_files: list, workers: int, place_valid_classes: dict):
+    """
+    :return: generator of verify_label_file results in the order of label_files
+    """
+    verify = functools.partial(verify_label_file, place_valid_classes=place_valid_classes)
+    if workers > 1:
+        logger.info(f"Verifying with {workers} worker processes")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunk_size = max(1, len(label_files) // (workers * 16))
+            yield from executor.map(verify, label_files, chunksize=chunk_size)
+    else:
+        yield from map(verify, label_files)
+
+
+def write_html_pages(path_jsonl: str, path_out: str, summary: dict, page_size=REPORT_PAGE_SIZE):
+    """
+    build the HTML report from the JSON Lines error records one page at a time
+    :return: a list of the page filenames
+    """
+    page_filenames = []
+
+    def _write_page(page_records):
+        page_filename = f"{path_out}.{len(page_filenames) + 1}.html"
+        html = json2html.json2html.convert(json=page_records)
+        utils.to_file(html, page_filename)
+        page_filenames.append(page_filename)
+
+    records = []
+    with open(path_jsonl, 'r', encoding='utf-8') as jsonl_file:
+        for line in jsonl_file:
+            records.append(serializer.loads(line))
+            if len(records) == page_size:
+                _write_page(records)
+                records = []
+    if records:
+        _write_page(records)
+
+    links = "".join(f'<li><a href="{os.path.basename(page_filename)}">{os.path.basename(page_filename)}</a></li>'
+                    for page_filename in page_filenames)
+    html = json2html.json2html.convert(json=summary) + f"<ul>{links}</ul>"
+    utils.to_file(html, path_out + ".html")
+
+    return page_filenames
+
+
+def verify_project85_labels_streaming(label_files: list, path_out: str, workers: int = 1,
+                                      place_valid_classes: dict = PLACE_VALID_CLASSES):
+    """
+    write every error record to path_out.jsonl as soon as it is found instead of keeping them in memory.
+    path_out only gets the summary counts and the HTML report is paged.
+    """
+    path_jsonl = path_out + ".jsonl"
+    error_counts = {"label_count_errors": 0, "label_id_errors": 0, "out_of_place_errors": 0}
+    with open(path_jsonl, 'w', encoding='utf-8') as jsonl_file:
+        for result in _iter_verification_results(label_files, workers, place_valid_classes):
+            for error_type, error in zip(error_counts.keys(), result):
+                if error:
+                    error_counts[error_type] += 1
+                    record = {"type": error_type, "error": error}
+                    jsonl_file.write(serializer.dumps(record, compact=True) + "\n")
+                    # flush so that partial results can be inspected during long runs
+                    jsonl_file.flush()
+
+    summary = {"file_count": len(label_files)}
+    summary.update(error_counts)
+    summary["error_details"] = os.path.basename(path_jsonl)
+
+    json_data = serializer.dumps(summary)
+    utils.to_file(json_data, path_out)
+
+    page_filenames = write_html_pages(path_jsonl, path_out, summary)
+    logger.info(f"Wrote {summary} and {len(page_filenames)} HTML pages")
+
+
+def verify_project85_labels(path_in: str, path_out: str, workers: int = 1, stream_report: bool = False,
+                            place_classes_file: str = None):
     label_files = utils.glob_files_all(path_in, file_type="*.json")
     logger.info(f"Found {len(label_files)} label_files")
 
@@ -87,102 +309,25 @@ def verify_project85_labels(path_in: str, path_out: str):
     if out_dir and not os.path.exists(out_dir):
         os.mkdir(out_dir)
 
+    place_valid_classes = load_place_valid_classes(place_classes_file)
+
+    if stream_report:
+        verify_project85_labels_streaming(label_files, path_out, workers=workers,
+                                          place_valid_classes=place_valid_classes)
+        return
+
+    # merge the per file results in the order of label_files
     label_count_errors = []
     label_id_errors = []
     out_of_place_errors = []
-
-    for label_file in label_files:
-        logger.info(f"Processing {label_file}")
-        label_data_json = utils.from_file(label_file)
-
-        image = label_data_json.get("image")
-        image_basename = os.path.basename(image.get("file_name"))
-        if not image_basename:
-            logger.error(f"empty image file name {image}")
-            continue
-
-        labels_2d = label_data_json.get("annotations")
-        labels_3d = label_data_json.get("pcd_annotations")
-
-        # 1. label count errors
-        count_labels_2d = len(labels_2d)
-        count_labels_3d = len(labels_3d)
-
-        if count_labels_2d != count_labels_3d or count_labels_2d == 0 or count_labels_3d == 0:
-            error_dict = dict()
-            error_dict[image_basename] = {"2d_label_count": count_labels_2d,
-                                          "3d_label_count": count_labels_3d}
-            label_count_errors.append(error_dict)
-
-        # 2. label ID errors
-        anno_ids_2d = [str(anno.get("id")) for anno in labels_2d]
-        anno_ids_3d = [str(anno.get("obj_id")) for anno in labels_3d]
-        anno_ids_2d.sort()
-        anno_ids_3d.sort()
-
-        # 2D against 3D
-        # key: image_name
-        # value: {
-        #    anno_ids_2d: [],
-        #    anno_ids_3d: [],
-        #    anno_id_errors: []
-        # }
-        label_id_error = dict()
-        anno_id_errors = []
-        for id_2d, anno_id_2d in enumerate(anno_ids_2d):
-            if not anno_id_2d.isdigit():
-                anno_id_errors.append(LabelIDError.Invalid_ID_2D.name)
-            for id_3d, anno_id_3d in enumerate(anno_ids_3d):
-                if not anno_id_3d.isdigit():
-                    anno_id_errors.append(LabelIDError.Invalid_ID_3D.name)
-
-                if id_2d == id_3d and anno_id_2d != anno_id_3d:
-                    anno_id_errors.append(LabelIDError.ID_Mismatch.name)
-        if len(anno_id_errors) > 0:
-            label_id_error[image_basename] = {
-                "anno_ids_2d": anno_ids_2d,
-                "anno_ids_3d": anno_ids_3d,
-                "anno_id_errors": anno_id_errors
-            }
+    results = _iter_verification_results(label_files, workers, place_valid_classes)
+    for label_count_error, label_id_error, out_of_place_error in results:
+        if label_count_error:
+            label_count_errors.append(label_count_error)
+        if label_id_error:
             label_id_errors.append(label_id_error)
-
-        # logger.info(label_id_errors)
-
-        # 3. out of place classes
-        categories = label_data_json.get("categories")
-        anno_names_2d = [categories[anno.get("category_id")].get("name") for anno in labels_2d]
-        anno_names_3d = [anno.get("obj_type") for anno in labels_3d]
-
-        anno_names_2d.sort()
-        anno_names_3d.sort()
-
-        tokens = image_basename.split('_')
-        place = tokens[1]
-        # logger.info(place)
-
-        invalid_classes_2d = []
-        valid_classes = PLACE_CLASSES_STATIC.get(place) + CLASS_PERSON
-        for anno_name_2d in anno_names_2d:
-            # skip OUT_OF_FOCUS
-            if anno_name_2d == OUT_OF_FOCUS:
-                continue
-            if anno_name_2d not in valid_classes:
-                invalid_classes_2d.append(anno_name_2d)
-
-        invalid_classes_3d = []
-        for anno_name_3d in anno_names_3d:
-            if anno_name_3d not in valid_classes:
-                invalid_classes_3d.append(anno_name_3d)
-
-        if len(invalid_classes_2d) > 0 or len(invalid_classes_3d) > 0:
-            out_of_place_errors.append({image_basename: {
-                "anno_names_2d": anno_names_2d,
-                "anno_names_3d": anno_names_3d,
-                "invalid_classes_2d": invalid_classes_2d,
-                "invalid_classes_3d": invalid_classes_3d
-            }})
-
-        # logger.info(out_of_place_errors)
+        if out_of_place_error:
+            out_of_place_errors.append(out_of_place_error)
 
     errors_data = {"file_count": len(label_files),
                    "label_count_errors": len(label_count_errors),
@@ -192,7 +337,7 @@ def verify_project85_labels(path_in: str, path_out: str):
                    "label_id_error_details": label_id_errors,
                    "out_of_place_error_details": out_of_place_errors}
 
-    json_data = json.dumps(errors_data, default=utils.default, ensure_ascii=False, indent=2)
+    json_data = serializer.dumps(errors_data)
     # logger.info(f"{json_data} {path_out}")
     utils.to_file(json_data, path_out)
 
@@ -204,9 +349,16 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--path_in", action="store", dest="path_in", type=str)
     parser.add_argument("--path_out", action="store", dest="path_out", type=str)
+    parser.add_argument("--workers", action="store", dest="workers", type=int, default=1,
+                        help="number of worker processes verifying label files in parallel")
+    parser.add_argument("--stream_report", action="store_true", dest="stream_report",
+                        help="write error records to a JSON Lines file as they are found and page the HTML report")
+    parser.add_argument("--place_classes", action="store", dest="place_classes", type=str,
+                        help="JSON file with key=place code value=list of static classes to add or override places")
 
     args = parser.parse_args()
 
     if not args.path_out:
         args.path_out = os.path.join(".", "verify85")
-    verify_project85_labels(args.path_in, args.path_out)
+    verify_project85_labels(args.path_in, args.path_out, workers=args.workers, stream_report=args.stream_report,
+                            place_classes_file=args.place_classes)